@@ -1,13 +1,426 @@
 import os
+import re
+import json
+import mmap
+import shlex
 import shutil
+import signal
+import socket
+import socketserver
+import fnmatch
+import hashlib
+import time
+import functools
+import inspect
+import io
+import subprocess
+import sys
+from string import Template
+from contextlib import contextmanager
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Self, Any
 
+try:
+    import readline
+except ImportError:     # Windows has no readline
+    readline = None
+
+try:
+    import fcntl
+except ImportError:     # Windows has no fcntl. Locking is skipped
+    fcntl = None
+
+
+# Markup places that hold css classes: class / className / :class values and classList calls
+_CLASS_CONTEXT_RE = re.compile(
+    r"(?<![\w.:-])(?P<bind>v-bind:|:)?(?:class|className)\s*=\s*"
+    r"(?P<value>\"[^\"]*\"|'[^']*'|\{(?:[^{}]|\{[^{}]*\})*\})"
+    r"|\bclassList\s*\.\s*(?:add|remove|toggle|contains|replace)\s*(?P<args>\((?:[^()]|\([^()]*\))*\))"
+)
+# String literal of a class expression
+_STRING_RE = re.compile(r"\"[^\"\n]*\"|'[^'\n]*'|`[^`]*`")
+# Same rules for the memory-mapped files
+_CLASS_CONTEXT_BYTES_RE = re.compile(_CLASS_CONTEXT_RE.pattern.encode("ascii"))
+_STRING_BYTES_RE = re.compile(_STRING_RE.pattern.encode("ascii"))
+
+
+def _class_spans(text: str):
+    """
+    Yield (start, end) of the markup text parts that are class names.
+
+    Static attribute value is a class list. Bound values, JSX expressions and classList arguments
+    are code, so only their string literals are class names
+    Args:
+        text: Markup text or its bytes, e.g. a memory-mapped file
+    """
+    context, strings = (_CLASS_CONTEXT_RE, _STRING_RE) if isinstance(text, str) else \
+        (_CLASS_CONTEXT_BYTES_RE, _STRING_BYTES_RE)
+    for m in context.finditer(text):
+        group = "args" if m.group("value") is None else "value"
+        start, end = m.start(group) + 1, m.end(group) - 1
+        if group == "value" and m.group("bind") is None and m.group(group)[:1] in ("\"", "'", b"\"", b"'"):
+            yield start, end
+            continue
+        for x in strings.finditer(text, start, end):
+            yield x.start() + 1, x.end() - 1
+
+
+def _scan_markup(job: tuple[str, str]) -> list[str]:
+    """
+    Return css names that are found in class places of the markup file.
+
+    Lives on module level to be run by worker processes.
+    The file is memory-mapped, only class places are decoded
+    Args:
+        job: File path and the pattern made by BEM._class_pattern
+    """
+    path, pattern = job
+    pattern = re.compile(pattern)
+    found = set()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+            for start, end in _class_spans(text):
+                found.update(pattern.findall(text[start:end].decode("utf-8", "ignore")))
+    return sorted(found)
+
+
+# Css parts kept as they are by the minifier: strings and unquoted urls. Comments are found in the same pass,
+# so a comment mark inside of a string is not a comment and a quote inside of a comment is not a string
+_CSS_TOKEN_RE = re.compile(
+    r"(?P<comment>/\*.*?(?:\*/|$))"
+    r"|(?P<keep>\"(?:\\.|[^\"\\\n])*\"?|'(?:\\.|[^'\\\n])*'?|\burl\(\s*[^\s\"')][^)]*\))",
+    re.S
+)
+
+
+def _minify_css(css: str) -> str:
+    """
+    Strip comments and whitespace, drop empty rules. Strings and urls are not changed
+    """
+    kept = []
+
+    def hide(match):
+        if match.group("comment") is not None:
+            return " "
+        kept.append(match.group("keep"))
+        return f"\0{len(kept) - 1}\0"
+
+    css = _CSS_TOKEN_RE.sub(hide, css)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    # Space before a colon matters in selectors, e.g. ".a :hover"
+    css = re.sub(r"([{;][\w-]+) :(?=[^{};]*[;}])", r"\1:", css)
+    css = css.replace(";}", "}")
+    # Removing an empty rule could empty its at-rule
+    prev = None
+    while prev != css:
+        prev = css
+        css = re.sub(r"(^|[{};])[^{};]+\{\}", r"\1", css)
+    return re.sub(r"\0(\d+)\0", lambda m: kept[int(m.group(1))], css.strip())
+
+
+def _rewrite_markup(job: tuple[str, str, dict]) -> bool:
+    """
+    Replace old css names with new ones in class places of the markup file. See _class_spans()
+
+    The file is written only if it has a match
+    Args:
+        job: File path, the pattern made by BEM._class_pattern and old to new names dict
+    Returns true if the file was changed
+    """
+    path, pattern, mapping = job
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        text = f.read()
+    pattern = re.compile(pattern)
+    parts = []
+    pos = 0
+    for start, end in _class_spans(text):
+        new, n = pattern.subn(lambda m: mapping[m.group(1)], text[start:end])
+        if n != 0:
+            parts.extend((text[pos:start], new))
+            pos = end
+    if pos == 0:
+        return False
+    parts.append(text[pos:])
+    new_text = "".join(parts)
+    with open(path, "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.write(new_text)
+    return True
+
+
+def _transactional(method):
+    """
+    Run node method inside of its controller transaction.
+
+    So the project is locked and the import file is written once
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.BEM.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _confirmed(method):
+    """
+    Ask removal permission before the node method locks the project.
+
+    So the console doesn't keep other controllers waiting for an answer.
+    The method is called with force=True once it is confirmed
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        if not self._confirm_remove(bound.arguments["force"]):
+            return False
+        bound.arguments["force"] = True
+        return method(*bound.args, **bound.kwargs)
+    return wrapper
+
+
+class _NameTrie:
+    """
+    Prefix tree of names used by the console completion
+    """
+    def __init__(self):
+        self.root = dict()      # Char to child node. None key marks the end of a name
+
+    def add(self, name: str):
+        """
+        Insert name into the tree
+        """
+        node = self.root
+        for ch in name:
+            node = node.setdefault(ch, dict())
+        node[None] = True
+
+    def remove(self, name: str):
+        """
+        Delete name and the branches left empty
+        """
+        path = [self.root]
+        for ch in name:
+            if ch not in path[-1]:
+                return
+            path.append(path[-1][ch])
+        path[-1].pop(None, None)
+        for i in range(len(name) - 1, -1, -1):
+            if len(path[i + 1]) != 0:
+                break
+            del path[i][name[i]]
+
+    def complete(self, prefix: str) -> list[str]:
+        """
+        Return sorted names that start with prefix
+        """
+        node = self.root
+        for ch in prefix:
+            if ch not in node:
+                return []
+            node = node[ch]
+        names = []
+        stack = [(node, prefix)]
+        while stack:
+            node, name = stack.pop()
+            for ch, child in node.items():
+                if ch is None:
+                    names.append(name)
+                else:
+                    stack.append((child, name + ch))
+        return sorted(names)
+
+
+class _ImportEdits:
+    """
+    Changes of the css import file that are not written yet.
+
+    The file is not loaded. Lines are found by a byte search of the memory-mapped file,
+    replaced byte ranges and appended text are kept till stream() copies the new file.
+    The file must not change meanwhile, so the project is locked.
+    The file stays mapped till close()
+    """
+    def __init__(self, path: Path):
+        self.cuts = dict()          # Byte offset of a replaced range to its length and new bytes
+        self.tail = b""             # Appended bytes
+        self._file = open(path, "rb")
+        # Empty file can't be mapped
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._mm = b""
+        else:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        i = self._mm.find(b"\n")
+        self.newline = "\r\n" if i > 0 and self._mm[i - 1:i] == b"\r" else "\n"
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+    @property
+    def changed(self) -> bool:
+        return len(self.cuts) != 0 or len(self.tail) != 0
+
+    def encode(self, text: str) -> bytes:
+        return text.replace("\n", self.newline).encode("utf-8")
+
+    def find(self, line: str) -> tuple | None:
+        """
+        Find the first occurrence of line in the edited file
+        Returns ("file", 0, offset), ("cut", offset, index in its new bytes), ("tail", 0, index) or None
+        """
+        needle = self.encode(line)
+        first = None
+        i = self._mm.find(needle)
+        while i != -1:
+            if not any(i < o + n and o < i + len(needle) for o, (n, _) in self.cuts.items()):
+                first = ("file", 0, i)
+                break
+            i = self._mm.find(needle, i + 1)
+        for o in sorted(self.cuts):
+            if first is not None and o > first[2]:
+                break
+            i = self.cuts[o][1].find(needle)
+            if i != -1:
+                return "cut", o, i
+        if first is not None:
+            return first
+        i = self.tail.find(needle)
+        return ("tail", 0, i) if i != -1 else None
+
+    def replace(self, mapping: dict) -> set:
+        """
+        Replace the first occurrence of every line at once. Empty new line removes the old one
+        Returns the lines that were found
+        """
+        spots = dict()
+        for line in sorted(mapping, key=len, reverse=True):
+            spot = self.find(line)
+            if spot is not None and not any(
+                    spot[:2] == x[:2] and spot[2] < x[2] + len(self.encode(k)) and x[2] < spot[2] + len(self.encode(line))
+                    for k, x in spots.items()):
+                spots[line] = spot
+        # Later spots go first, so indexes of the earlier ones stay right
+        for line, (kind, o, i) in sorted(spots.items(), key=lambda x: x[1], reverse=True):
+            old, new = self.encode(line), self.encode(mapping[line])
+            if kind == "file":
+                self.cuts[i] = (len(old), new)
+            elif kind == "cut":
+                length, value = self.cuts[o]
+                self.cuts[o] = (length, value[:i] + new + value[i + len(old):])
+            else:
+                self.tail = self.tail[:i] + new + self.tail[i + len(old):]
+        return set(spots)
+
+    def append(self, text: str):
+        self.tail += self.encode(text)
+
+    def stream(self, write, chunk: int):
+        """
+        Pass the file with the changes to write() by chunks
+        """
+        pos = 0
+        for o in sorted(self.cuts) + [None]:
+            end = len(self._mm) if o is None else o
+            for i in range(pos, end, chunk):
+                write(self._mm[i:min(i + chunk, end)])
+            if o is not None:
+                write(self.cuts[o][1])
+                pos = o + self.cuts[o][0]
+        write(self.tail)
+
+    def same(self, chunk: int) -> bool:
+        """
+        Check if the changes give the same bytes, e.g. a line was removed and appended back
+        """
+        size = len(self._mm) + len(self.tail) + sum(len(new) - n for n, new in self.cuts.values())
+        if size != len(self._mm):
+            return False
+        digest = hashlib.sha1()
+        self.stream(digest.update, chunk)
+        return digest.digest() == hashlib.sha1(self._mm).digest()
+
 
 class BEM:
     """
     BEM structure controller
     """
+    # Version of the to_json() snapshot format
+    SNAPSHOT_VERSION = 1
+    # Version of the modifiers manifest format
+    MANIFEST_VERSION = 2
+    # Folders changed less than this number of nanoseconds before a scan are scanned again next time
+    RACY_NS = 2 * 10 ** 9
+    # Files where css classes are used
+    MARKUP_SUFFIXES = (".html", ".htm", ".jsx", ".tsx", ".js", ".ts", ".vue")
+    # Less files are scanned in the current process
+    PARALLEL_THRESHOLD = 64
+    # @import statement with the imported path in the first group
+    IMPORT_RE = re.compile(r"""@import\s+(?:url\(\s*)?["']?([^"')\s;]+)["']?\s*\)?[^;]*;""")
+    # Path of a css url() in the "ref" group or of a string @import in the "ref2" group
+    REFERENCE_RE = re.compile(r"""url\(\s*(["']?)(?P<ref>[^"')\s]+)\1\s*\)|@import\s+(["'])(?P<ref2>[^"']+)\3""")
+    # Size of the chunks copied while the import file is rewritten
+    IMPORT_CHUNK = 1 << 18
+    # Folder for the controller caches related to root
+    CACHE_DIR = ".bem-cache"
+    # Folder of the css backups related to root
+    STORE_DIR = ".bem-store"
+
+    # Nested layout has a folder per object, flat one keeps every file in the block folder
+    LAYOUTS = ("nested", "flat")
+    # Events sent to the on() callbacks
+    EVENTS = ("created", "removed", "renamed")
+
+    # Default content of new css files by node type.
+    # $cssName, $name, $block, $parent and $value are substituted
+    TEMPLATES = {
+        "block": ".$cssName {\n\t\n}\n",
+        "element": ".$cssName {\n\t\n}\n",
+        "modifier": ".$cssName {\n\t\n}\n",
+        "value": ".$cssName {\n\t\n}\n"
+    }
+
+    # Console modes with their variations
+    MODES = ["exit", "create", "remove", "rename", "show", "fix", "parse", "code", "backup", "record", "play",
+             "migrate", "clone"]
+    MODE_VARIATIONS = [
+        ["0", "q"],
+        ["1", "new"],
+        ["2", "delete", "rm"],
+        ["3", "rn"],
+        ["4", "ls"],
+        ["5", "fx"],
+        ["6", "prs", "update", "scan", "rescan"],
+        ["7", "vscode"],
+        ["8"],
+        ["9", "rec"],
+        ["10", "replay"],
+        ["11", "layout"],
+        ["12", "cp", "copy"]
+    ]
+    MODES_HINT = ("Exit(0) / Create(1) / Remove(2) / Rename(3) / Show(4) / Fix(5) / Parse(6) / Code(7) / Backup(8)"
+                  " / Record(9) / Play(10) / Migrate(11) / Clone(12)\n"
+                  "One line: create m card __title size s m l; rename b card tile; clone card tile; record macro.txt")
+    TYPES = ["back", "block", "element", "modifier"]
+    TYPE_VARIATIONS = [["0", "q", "back"], ["1", "b"], ["2", "e", "el"], ["3", "m", "mod"]]
+    SHOW_TYPES = TYPES + ["all"]
+    SHOW_VARIATIONS = TYPE_VARIATIONS + [["4", "a", "everything"]]
+    # Objects printed by console show at once
+    SHOW_PAGE = 200
+
     @classmethod
     def get_default_bem(cls) -> Self:
         """
@@ -19,17 +432,10 @@ class BEM:
         return cls(root, blocks, css)
 
     @staticmethod
-    def _choose_option(hint: str, commands: list[str], variations: list[list[str]], prompt: str = "") -> str:
+    def _options(commands: list[str], variations: list[list[str]]) -> dict:
         """
-        Let user pick once from options
-        Args:
-            hint: Display for ?
-            commands: Possible commands
-            variations: For each command here is a list of variations
+        Build a dict to reduce commands variations
         """
-        inp = None
-
-        # Build a dict to reduce commands variations
         all_options = dict()
         for x in commands:
             all_options[x] = x
@@ -37,6 +443,19 @@ class BEM:
         for i in range(len(variations)):
             for x in variations[i]:
                 all_options[x] = commands[i]
+        return all_options
+
+    @staticmethod
+    def _choose_option(hint: str, commands: list[str], variations: list[list[str]], prompt: str = "") -> str:
+        """
+        Let user pick once from options
+        Args:
+            hint: Display for ?
+            commands: Possible commands
+            variations: For each command here is a list of variations
+        """
+        inp = None
+        all_options = BEM._options(commands, variations)
 
         while True:
             inp = input(prompt + "> ").lower()
@@ -51,7 +470,29 @@ class BEM:
 
         return all_options.get(inp)
 
-    def __init__(self, root: Path, blocks: Path, css: Path):
+    @classmethod
+    def from_snapshot(cls, root: Path, snapshot: Path | str | dict) -> Self:
+        """
+        Make a controller from to_json() output without scanning the blocks folder
+        Args:
+            root: Project folder path. Snapshot paths are related to it
+            snapshot: Path to a snapshot file, json string or already loaded dict
+        """
+        if isinstance(snapshot, Path):
+            snapshot = snapshot.read_text("utf-8")
+        if isinstance(snapshot, str):
+            snapshot = json.loads(snapshot)
+
+        if snapshot.get("version") != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {snapshot.get('version')}")
+
+        bem = cls(root, root / snapshot["blocksDir"], root / snapshot["cssFile"], autoparse=False,
+                  layout=snapshot.get("layout", "nested"))
+        bem.load_snapshot(snapshot)
+        return bem
+
+    def __init__(self, root: Path, blocks: Path, css: Path, autoparse: bool = True,
+                 editor: str = "code", templates: dict | None = None, layout: str = "nested"):
         """
         Initialize controller
 
@@ -59,6 +500,10 @@ class BEM:
             root:   Project folder path
             blocks: Blocks folder path related to root
             css:    Path to main css file where others are imported
+            autoparse: Find existing blocks right away
+            editor: Command that opens css files. Could have arguments like "code -r"
+            templates: Content of new css files by node type. See TEMPLATES
+            layout: "nested" (blocks/card/__title/card__title.css) or "flat" (blocks/card/card__title.css)
         """
 
         # Check paths existence
@@ -68,18 +513,56 @@ class BEM:
             raise FileNotFoundError("Can't find blocks folder")
         if not css.exists():
             raise FileNotFoundError("Can't find css file")
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout}")
 
         self.rootDir = root         # Project folder path
         self.blocksDir = blocks     # Blocks folder path related to root
         self.cssFile = css          # Path to main css file where others are imported
+        self.cacheDir = root / self.CACHE_DIR   # Folder for the controller caches
+        self.storeDir = root / self.STORE_DIR   # Content-addressed backups of css files
+        self.backup_keep = 50       # Number of backups kept in the store. 0 keeps everything
+        self.layout = layout        # Files layout. One of LAYOUTS
 
         self.blocks = []            # List of all current blocks
 
         self.autolaunch = False     # Launch vs code after creation
-
+        self.editor = editor        # Editor command used by launch_editor
+
+        self._transaction_depth = 0     # Nesting level of transaction()
+        self._lock_fd = None            # Opened lock file descriptor
+        self._lock_modes = []           # Stack of held lock modes of lock()
+        self._editor_queue = dict()     # Editor command and files waiting for the launch
+
+        self._import_text = None        # Import file text loaded by the transaction
+        self._import_loaded = None      # Import file text before the transaction changes
+        self._import_edits = None       # Import file changes of the transaction while its text isn't loaded
+        self._imports_changed = False   # Import file text must be written
+        self._parsed = False            # Parse was done during the transaction
+
+        self._hashes = dict()           # Css file path to its (mtime, size, content hash)
+        self._manifest = None           # Modifier entries of the saved manifest while parse() runs
+        self._manifest_new = None       # Modifier entries found by the running parse()
+        self._stored = dict()           # File path to its (mtime, size, store hash)
+        self._backup = None             # Files of the backup being made. Related path to store hash
+        self.skipped_writes = 0         # Unchanged writes skipped by the last operation
+
+        self._templates = dict()        # Compiled TEMPLATES
+        self._default_hashes = dict()   # Hash of rendered template by (node type, css name)
+        for node_type, template in (self.TEMPLATES | (templates or dict())).items():
+            self.set_template(node_type, template)
+
+        self._hooks = {x: [] for x in self.EVENTS}  # Callbacks by event
+        self._events = []               # Events waiting for the transaction end
+        self._event_capture = None      # Events grouped by the current rename instead of being sent
+
+        self._names = dict()            # Completion tries by (ancestor css name, type)
+        self._completion_scope = None   # Key of self._names used by the current prompt
+        self._macro = None              # File where console commands are recorded
 
         # Find existing blocks
-        self.parse(False)
+        if autoparse:
+            self.parse(False)
 
     def start_loop(self, cond: bool = True):
         """
@@ -87,33 +570,73 @@ class BEM:
         Args:
             cond: Just a condition to be cycled
         """
+        if readline is not None:
+            readline.set_completer(self._complete)
+            readline.set_completer_delims(" \t\n;")
+            if "libedit" in (readline.__doc__ or ""):
+                readline.parse_and_bind("bind ^I rl_complete")
+            else:
+                readline.parse_and_bind("tab: complete")
         print("Use ? for hint")
         while cond:
             self.action()
 
     def action(self):
         """
-        Pick working mode and perform it
-        """
-        mode = self._choose_option(
-            "Exit(0) / Create(1) / Remove(2) / Rename(3) / Show(4) / Fix(5) / Parse(6) / Code(7) / Backup(8)",
-            ["exit", "create", "remove", "rename", "show", "fix", "parse", "code", "backup"],
-            [
-                ["0", "q"],
-                ["1", "new"],
-                ["2", "delete", "rm"],
-                ["3", "rn"],
-                ["4", "ls"],
-                ["5", "fx"],
-                ["6", "prs", "update", "scan", "rescan"],
-                ["7", "vscode", "vs code"],
-                ["8"]
-            ]
-        )
+        Read a line and perform its commands.
+
+        Everything made by one command is a single transaction.
+        Questions are asked before it starts, so the project isn't locked while the console waits
+        """
+        line = input("> ")
+        skipped = 0
+        for command in line.split(";"):
+            self.skipped_writes = 0
+            self.command(command)
+            skipped += self.skipped_writes
+        if skipped:
+            print(f"Skipped {skipped} unchanged writes")
+
+    def command(self, text: str, force: bool = False):
+        """
+        Perform a console command.
+
+        Single word asks the rest interactively, e.g. "create".
+        Otherwise, it is a one line command, e.g. "create m card __title size s m l"
+        Args:
+            text: Command line
+            force: Do not ask for removal confirmation
+        """
+        words = text.split()
+        if len(words) == 0:
+            return
+        if words[0] in ("?", "help"):
+            print(self.MODES_HINT)
+            return
+        mode = self._options(self.MODES, self.MODE_VARIATIONS).get(words[0].lower())
+        if mode is None:
+            print("Unknown option! Try ?")
+            return
+        args = words[1:]
 
         if mode == "exit":
             self.exit()
             return
+        elif mode == "record":
+            if self._macro is not None and len(args) == 0:
+                self._macro = None
+                print("Recording stopped")
+            else:
+                file = args[0] if args else self._input("Set macro file: ")
+                if file:
+                    self.record(Path(file))
+                    print(f"Recording to {file}. Type record again to stop")
+            return
+        elif mode == "play":
+            file = args[0] if args else self._input("Set macro file: ")
+            if file:
+                self.play(Path(file))
+            return
         elif mode == "backup":
             css_copy = self.make_import_backup()
             print(f"{self.cssFile} copied as {css_copy}")
@@ -125,52 +648,198 @@ class BEM:
             print(f"Updated {c} lines")
         elif mode == "parse":
             self.parse(False)
+        elif mode == "migrate":
+            layout = args[0] if args else self._input(f"Set layout ({' / '.join(self.LAYOUTS)}): ")
+            if layout is None:
+                return
+            try:
+                print(f"Moved {self.migrate_layout(layout)} files")
+            except (ValueError, FileExistsError) as e:
+                print(e)
+                return
+            args = [layout]
+        elif mode == "clone":
+            name = args[0] if args else self._input("Set block name: ", ("", "block"))
+            if name is None:
+                return
+            new_name = args[1] if len(args) > 1 else self._input("Enter new name: ")
+            if new_name is None:
+                return
+            try:
+                self.clone(name, new_name)
+                print("Cloned")
+            except FileExistsError:
+                print("Already exists!")
+                return
+            except FileNotFoundError:
+                print("Not exist!")
+                return
+            except ValueError as e:
+                print(e)
+                return
+            args = [name, new_name]
         elif mode == "show":
-            obj_type = self._choose_option(
-                "Back(0) / Block(1) / Element(2) / Modifier(3) / Everything(4): ",
-                ["back", "block", "element", "modifier", "all"],
-                [["0", "q", "back"], ["1", "b"], ["2", "e", "el"],
-                    ["3", "m", "mod"], ["4", "a", "everything"]],
-                prompt="- " + mode + " "
-            )
-            if obj_type == "back":
+            if args:
+                obj_type = self._options(self.SHOW_TYPES, self.SHOW_VARIATIONS).get(args[0].lower())
+            else:
+                obj_type = self._choose_option(
+                    "Back(0) / Block(1) / Element(2) / Modifier(3) / Everything(4): ",
+                    self.SHOW_TYPES, self.SHOW_VARIATIONS,
+                    prompt="- " + mode + " "
+                )
+            if obj_type in (None, "back"):
                 return
-            self.show(obj_type)
+            # show <type> [css names glob] [page]
+            pattern = args[1] if len(args) > 1 and args[1] != "*" else None
+            page = int(args[2]) if len(args) > 2 and args[2].isdigit() and int(args[2]) > 0 else 1
+            count = self.show(obj_type, pattern, (page - 1) * self.SHOW_PAGE, self.SHOW_PAGE)
+            pages = -(-count // self.SHOW_PAGE)
+            if pages > 1:
+                print(f"Page {page} of {pages}. Next one: show {obj_type} {pattern or '*'} {page % pages + 1}")
+            args = [obj_type] + args[1:3]
         else:
-            obj_type = self._choose_option(
-                "Back(0) / Block(1) / Element(2) / Modifier(3): ",
-                ["back", "block", "element", "modifier"],
-                [["0", "q", "back"], ["1", "b"], [
-                    "2", "e", "el"], ["3", "m", "mod"]],
-                prompt="- " + mode + " "
-            )
-            if obj_type == "back":
+            if args:
+                parsed = self._parse_command(mode, args)
+            else:
+                parsed = self._ask_command(mode)
+            if parsed is None or not self._perform(mode, *parsed, force=force):
                 return
-            # Ask the object name
+            args = self._format_command(*parsed)
+
+        if self._macro is not None:
+            with open(self._macro, "a", encoding="utf-8") as f:
+                f.write(" ".join([mode] + args) + "\n")
+
+    def _ask_command(self, mode: str) -> tuple | None:
+        """
+        Ask object type and names for create / remove / rename
+        Returns object data and new name or None if it was cancelled
+        """
+        obj_type = self._choose_option(
+            "Back(0) / Block(1) / Element(2) / Modifier(3): ",
+            self.TYPES, self.TYPE_VARIATIONS,
+            prompt="- " + mode + " "
+        )
+        if obj_type == "back":
+            return None
+        # Ask the object name
+        data = self._resolve_type(obj_type, mode == "create")
+        if data[1] is None:
+            return None
+        new_name = None
+        if mode == "rename":
+            new_name = input("Enter new name: ")
+        return data, new_name
+
+    def _parse_command(self, mode: str, args: list[str]) -> tuple | None:
+        """
+        Resolve object data of one line create / remove / rename.
+
+        Arguments are type, block, element, modifier, values or new name.
+        Element is passed to a modifier only if it starts with "__"
+        Returns object data and new name or None if it is wrong
+        """
+        usage = f"Usage: {mode} <type> <block> [__element] [modifier] [values | new name]"
+        obj_type = self._options(self.TYPES, self.TYPE_VARIATIONS).get(args[0].lower())
+        names = args[1:]
+        new_name = None
+        if mode == "rename" and len(names) > 1:
+            new_name = names.pop()
+        if obj_type in (None, "back") or len(names) == 0 or (mode == "rename" and new_name is None):
+            print(usage)
+            return None
+
+        # Signature of object:  type, name, ancestor, values
+        data = [obj_type, None, None, None]
+        if obj_type == "block":
+            data[1] = names[0]
+            return tuple(data), new_name
+
+        block = self._get_object(names[0], self.blocks)
+        if block is None:
+            return None
+        names = names[1:]
+        if len(names) == 0:
+            print(usage)
+            return None
+        if obj_type == "element":
+            data[1], data[2] = names[0], block
+            return tuple(data), new_name
+
+        ancestor = block
+        if names[0].startswith("__"):
+            ancestor = self._get_object(names[0], block.elements)
+            names = names[1:]
+        if ancestor is None or len(names) == 0:
+            print(usage)
+            return None
+        data[1], data[2] = names[0], ancestor
+        if mode == "create" and len(names) > 1:
+            data[3] = names[1:]
+        return tuple(data), new_name
+
+    @staticmethod
+    def _format_command(data: tuple, new_name: str | None) -> list[str]:
+        """
+        Return one line command arguments of object data
+        """
+        obj_type, name, ancestor, values = data
+        args = [obj_type]
+        if ancestor is not None:
+            if ancestor.ancestor is not None:
+                args.append(ancestor.ancestor.name)
+            args.append(ancestor.name)
+        args.append(name)
+        args.extend(values or [])
+        if new_name is not None:
+            args.append(new_name)
+        return args
+
+    def _perform(self, mode: str, data: tuple, new_name: str | None, force: bool = False) -> bool:
+        """
+        Create, remove or rename object and print the result
+        Returns true if there were no errors
+        """
+        try:
             if mode == "create":
-                data = self._resolve_type(obj_type, True)
-                if data[1] is None:
-                    return
-                try:
-                    self.create(*data)
-                    print("Created")
-                except FileExistsError:
-                    print("Already exists!")
+                self.create(*data)
+                print("Created")
+            elif mode == "remove":
+                self.remove(*data, force=force)
+                print("Removed")
+            elif mode == "rename":
+                self.rename(new_name, *data)
+                print("Renamed")
+        except FileExistsError:
+            print("Already exists!")
+            return False
+        except FileNotFoundError:
+            print("Not exist!")
+            return False
+        except ValueError as e:
+            print(e)
+            return False
+        return True
 
-            else:
-                data = self._resolve_type(obj_type, False)
-                if data[1] is None:
-                    return
-                try:
-                    if mode == "remove":
-                        self.remove(*data)
-                        print("Removed")
-                    if mode == "rename":
-                        new_name = input("Enter new name: ")
-                        self.rename(new_name, *data)
-                        print("Renamed")
-                except FileNotFoundError:
-                    print("Not exist!")
+    def record(self, file: Path):
+        """
+        Start saving console commands to file as one line commands
+        """
+        file.write_text("", "utf-8")
+        self._macro = file
+
+    def play(self, file: Path):
+        """
+        Perform commands saved by record() in one transaction.
+
+        Removal is not confirmed
+        """
+        with self.transaction():
+            for line in file.read_text("utf-8").splitlines():
+                if line.strip().startswith("#"):
+                    continue
+                for command in line.split(";"):
+                    self.command(command, force=True)
 
     @staticmethod
     def exit():
@@ -198,26 +867,87 @@ class BEM:
             print(f"{obj_name} doesn't exist!. Try parse")
         return obj
 
-    def _remove_block(self, block_name: str):
+    def _siblings(self, obj) -> list:
+        """
+        Return the model list where obj is kept
         """
-        Remove block from self.blocks by name.
+        if obj.type == "block":
+            return self.blocks
+        if obj.type == "element":
+            return obj.ancestor.elements
+        return obj.ancestor.modifiers
 
-        Raise error if it has no such a name.
+    def _model_add(self, obj):
+        """
+        Put obj into the model. Replace the object with the same name
+        """
+        self._model_remove(obj)
+        self._siblings(obj).append(obj)
+
+    def _model_remove(self, obj, name: str | None = None):
+        """
+        Remove object from the model by name
+        Args:
+            obj: Object or its namesake
+            name: Name to be removed. obj.name by default
         """
-        ind = None
-        for i in range(len(self.blocks)):
-            if self.blocks[i].name == block_name:
-                ind = i
-        self.blocks.pop(ind)
+        name = name or obj.name
+        siblings = self._siblings(obj)
+        siblings[:] = [x for x in siblings if x.name != name]
 
     @staticmethod
-    def _input(prompt: str) -> str | None:
+    def _scope(obj) -> tuple[str, str]:
+        """
+        Return completion scope of obj
+        """
+        return obj.ancestor.cssName if obj.ancestor else "", obj.type
+
+    def _index_add(self, obj):
+        """
+        Add obj name to the completion
+        """
+        self._names.setdefault(self._scope(obj), _NameTrie()).add(obj.name.lstrip("_"))
+
+    def _index_remove(self, obj):
+        """
+        Remove obj name from the completion
+        """
+        trie = self._names.get(self._scope(obj))
+        if trie is not None:
+            trie.remove(obj.name.lstrip("_"))
+
+    def _index_rebuild(self):
+        """
+        Fill the completion with the model names
+        """
+        self._names.clear()
+        for x in self.iter_nodes():
+            self._index_add(x)
+
+    def _complete(self, text: str, state: int) -> str | None:
+        """
+        Readline completer. Suggest names from the current scope
+        """
+        trie = self._names.get(self._completion_scope)
+        if trie is None:
+            return None
+        options = trie.complete(text.lstrip("_"))
+        return options[state] if state < len(options) else None
+
+    def _input(self, prompt: str, scope: tuple[str, str] | None = None) -> str | None:
         """
         Input name.
         If name is 0 then return None
+        Args:
+            prompt: Text before the input
+            scope: Complete names from this scope. See _scope()
         """
         while True:
-            s = input(prompt)
+            self._completion_scope = scope
+            try:
+                s = input(prompt)
+            finally:
+                self._completion_scope = None
             if s == "0":
                 print("Going back")
                 return None
@@ -236,21 +966,24 @@ class BEM:
         # Signature of object:  type, name, ancestor, values
         data = [obj_type, None, None, None]
 
+        blocks_scope = ("", "block")
         if obj_type == "block":
-            block_name = self._input("Set block name: ")
+            block_name = self._input("Set block name: ", None if create else blocks_scope)
             data[1] = block_name
         if obj_type == "element":
             block = self._get_object(self._input(
-                f"Set parent block name: "), self.blocks)
+                f"Set parent block name: ", blocks_scope), self.blocks)
             if block:
-                element_name = self._input("Set element name: ")
+                element_name = self._input("Set element name: ",
+                                           None if create else (block.cssName, "element"))
                 data[1] = element_name
                 data[2] = block
         if obj_type == "modifier":
             block = self._get_object(self._input(
-                f"Set parent block name: "), self.blocks)
+                f"Set parent block name: ", blocks_scope), self.blocks)
             if block:
-                element = self._input("Set element name(empty for block modifier): ")
+                element = self._input("Set element name(empty for block modifier): ",
+                                      (block.cssName, "element"))
                 element = "__" + element.lstrip("_")
                 ancestor = None
                 if element == "__":
@@ -258,7 +991,8 @@ class BEM:
                 else:
                     ancestor = self._get_object(element, block.elements)
                 if ancestor:
-                    modifier_name = self._input("Set modifier name: ")
+                    modifier_name = self._input("Set modifier name: ",
+                                                None if create else (ancestor.cssName, "modifier"))
 
                     if create:
                         values = self._input("Set modifier values by spaces(empty for bool): ")
@@ -269,13 +1003,46 @@ class BEM:
 
         return tuple(data)
 
+    def iter_blocks(self):
+        """
+        Yield blocks without copying the list
+        """
+        yield from self.blocks
+
+    def iter_elements(self):
+        """
+        Yield elements block by block
+        """
+        for x in self.blocks:
+            yield from x.elements
+
+    def iter_modifiers(self, ancestor_type: str | None = None):
+        """
+        Yield modifiers depth-first: block modifiers go before the modifiers of its elements
+        Args:
+            ancestor_type: Yield only modifiers of "block" or "element"
+        """
+        for x in self.blocks:
+            if ancestor_type != "element":
+                yield from x.modifiers
+            if ancestor_type != "block":
+                for xe in x.elements:
+                    yield from xe.modifiers
+
+    def iter_nodes(self):
+        """
+        Yield every object depth-first: block, its modifiers, then elements with their modifiers
+        """
+        for x in self.blocks:
+            yield from x.iter_tree()
+
     def get_blocks(self) -> tuple:
         """
         Return the list of blocks in BEM.
 
         Could parse() before to update the list.
         """
-        return tuple(self.blocks)
+        return tuple(self.iter_blocks())
 
     def get_elements(self) -> tuple:
         """
@@ -283,10 +1050,7 @@ class BEM:
 
         Could parse() before to update the list.
         """
-        els = []
-        for x in self.blocks:
-            els.extend(x.elements)
-        return tuple(els)
+        return tuple(self.iter_elements())
 
     def get_modifiers(self) -> tuple[tuple, tuple]:
         """
@@ -294,61 +1058,309 @@ class BEM:
 
         Could parse() before to update the list.
         """
-        els = self.get_elements()
-        block_mods = []
-        for x in self.blocks:
-            block_mods.extend(x.modifiers)
-        el_mods = []
-        for x in els:
-            el_mods.extend(x.modifiers)
-        return tuple(block_mods), tuple(el_mods)
+        return tuple(self.iter_modifiers("block")), tuple(self.iter_modifiers("element"))
 
     def fix_imports(self) -> int:
         """
         Call update_import_line method of every object
         """
-        self.parse()
+        with self.transaction():
+            if not self._parsed:
+                self.parse()
+            c = 0
+            for x in self.iter_nodes():
+                c += x.update_import_line()
+        return c
+
+    def _git(self, *args: str) -> list[str] | None:
+        """
+        Run git in the blocks folder. Return output lines or None if git fails
+        """
+        try:
+            res = subprocess.run(["git", *args], cwd=self.blocksDir, capture_output=True, text=True)
+        except OSError:
+            return None
+        if res.returncode != 0:
+            return None
+        return [x for x in res.stdout.splitlines() if x]
+
+    def _git_changed_blocks(self, since: str) -> set[str] | None:
+        """
+        Return names of blocks with paths changed since git ref, including uncommitted and untracked ones.
+
+        None is returned if there is no git repository
+        """
+        changed = self._git("diff", "--name-only", "--no-renames", "--relative", since, "--", ".")
+        untracked = self._git("ls-files", "--others", "--exclude-standard", "--", ".")
+        if changed is None or untracked is None:
+            return None
+        return {Path(x).parts[0] for x in changed + untracked}
+
+    @staticmethod
+    def _block_import_lines(block) -> list[str]:
+        """
+        Return import lines of the block, its elements and modifiers
+        """
+        lines = []
+        for x in block.iter_tree():
+            lines.extend(x.get_import_lines())
+        return lines
+
+    def _folder_import_entries(self, names) -> dict:
+        """
+        Find import lines of the css import file that point into the block folders.
+
+        The file is read line by line. An entry is the import line with the comment line before it
+        Args:
+            names: Block folder names
+        Returns dict where key is block name and value is list of (imported path, entry)
+        """
+        base = os.path.relpath(self.blocksDir, self.cssFile.parent).replace(os.sep, "/")
+        base = "" if base == "." else base + "/"
+        entries = {x: [] for x in names}
+
+        def scan(lines):
+            prev = ""
+            for line in lines:
+                m = self.IMPORT_RE.search(line)
+                if m is not None and m.group(1).startswith(base):
+                    name, _, rest = m.group(1)[len(base):].partition("/")
+                    if name in entries and rest:
+                        comment = prev if prev.strip().startswith("/*") and prev.strip().endswith("*/") else ""
+                        entries[name].append((m.group(1), comment + line))
+                prev = line
+
+        if self._import_text is not None:
+            scan(self._import_text.splitlines(True))
+        else:
+            with self.lock(exclusive=False), open(self.cssFile, "r", encoding="utf-8") as f:
+                scan(f)
+        return entries
+
+    def refresh_from_git(self, since: str = "HEAD") -> int:
+        """
+        Parse again only the blocks changed according to git and update their import lines.
+
+        Full parse and fix_imports() are done if there is no git repository
+        Args:
+            since: Git ref to compare the working tree with, e.g. ORIG_HEAD after pull
+        Returns the number of added and removed import lines
+        """
+        names = self._git_changed_blocks(since)
+        if names is None:
+            return self.fix_imports()
+
         c = 0
-        for x in self.get_blocks():
-            c += x.update_import_line()
-            for xe in x.elements:
-                c += xe.update_import_line()
-                for xm in xe.modifiers:
-                    c += xm.update_import_line()
-            for xm in x.modifiers:
-                c += xm.update_import_line()
+        with self.transaction():
+            # Model could be parsed after the change or not at all, so old lines are taken from the import file
+            entries = self._folder_import_entries(names)
+            for name in sorted(names):
+                for x in [x for x in self.blocks if x.name == name]:
+                    self._model_remove(x)
+
+                new_lines = []
+                if self.blocksDir.joinpath(name).is_dir():
+                    block = Block(self, name)
+                    block.parse_descendants()
+                    self._model_add(block)
+                    new_lines = self._block_import_lines(block)
+
+                paths = {self.IMPORT_RE.search(x).group(1) for x in new_lines}
+                for path, line in entries[name]:
+                    if path not in paths:
+                        self.remove_import(line)
+                        c += 1
+                for line in new_lines:
+                    if not self.has_import(line):
+                        self.append_import(line)
+                        c += 1
+            self._index_rebuild()
         return c
 
-    def show(self, objs_type):
+    def replace_import(self, line: str, new_line: str):
+        """
+        Replace import line in place. Append new_line if there is no line
+        """
+        self.replace_imports({line: new_line})
+
+    def replace_imports(self, mapping: dict):
+        """
+        Replace import lines in place by a single pass over the css import file.
+
+        Only the first occurrence of every line is replaced. New lines of the missing ones are appended
+        Args:
+            mapping: Old line to new line. Empty new line removes the old one
+        """
+        if len(mapping) == 0:
+            return
+        pattern = re.compile("|".join(re.escape(x) for x in sorted(mapping, key=len, reverse=True)))
+        found = set()
+
+        def replace(m):
+            if m.group(0) in found:
+                return m.group(0)
+            found.add(m.group(0))
+            return mapping[m.group(0)]
+
+        with self.transaction():
+            if self._import_text is None:
+                # Line changes don't need the text. See _ImportEdits
+                found = self._edits().replace(mapping)
+                self._edits().append("".join(v for k, v in mapping.items() if k not in found))
+                self._imports_changed = True
+                return
+            text = pattern.sub(replace, self._get_imports())
+            self._set_imports(text + "".join(v for k, v in mapping.items() if k not in found))
+
+    def migrate_layout(self, layout: str) -> int:
+        """
+        Move css files to another layout and update their import lines in place.
+
+        Other files of the nested element and modifier folders go to the block folder.
+        Relative urls and imports inside of the moved css files are changed to the new places
+        Args:
+            layout: One of LAYOUTS
+        Returns the number of moved css files
+        Raises ValueError for names the flat layout can't tell apart, FileExistsError for assets with one name
+        """
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout}")
+        if layout == self.layout:
+            return 0
+
+        with self.transaction():
+            self.parse()
+            # Objects and their files before the move
+            old = [(x, x.get_css_entries()) for x in self.iter_nodes()]
+            if layout == "flat":
+                for x, _ in old:
+                    self._check_name(x.name, layout)
+
+            previous, self.layout = self.layout, layout
+            moves = dict()      # Old path to the new one
+            lines = []
+            assets = set()
+            for x, entries in old:
+                x.update_name(x.name)       # Ancestors go first, so paths are right
+                for value, file, line in entries:
+                    if value is not None:
+                        x._set_value(value)
+                    if file.exists():
+                        moves[Path(os.path.normpath(file))] = Path(os.path.normpath(x.cssFile))
+                        lines.append((line, x.build_import_line()))
+                        if layout == "flat" and x.ancestor is not None:
+                            assets.add((file.parent, x.cssFile.parent))
+                x.update_name(x.name)
+
+            # Nested object folders hold child folders ("_" names) and css files of the objects. The rest goes along
+            for folder, target in assets:
+                for entry in folder.iterdir():
+                    if entry.suffix == ".css" or entry.is_dir() and entry.name.startswith("_"):
+                        continue
+                    dest = target / entry.name
+                    if dest.exists() or dest in moves.values():
+                        # Nothing is moved yet
+                        self.layout = previous
+                        self.parse()
+                        raise FileExistsError(f"Can't move {entry}: {dest} already exists")
+                    moves[Path(os.path.normpath(entry))] = Path(os.path.normpath(dest))
+
+            for src, dest in moves.items():
+                if src != dest:
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(src, dest)
+            for line, new_line in lines:
+                self.replace_import(line, new_line)
+            for src, dest in moves.items():
+                if dest.suffix == ".css":
+                    text = dest.read_text("utf-8")
+                    changed = self._move_references(text, src.parent, dest.parent, moves)
+                    if changed != text:
+                        self.write_css(dest, changed)
+
+            # Remove folders left empty
+            for path, dirs, files in os.walk(self.blocksDir, topdown=False):
+                path = Path(path)
+                if path.parent != self.blocksDir and path != self.blocksDir and not any(path.iterdir()):
+                    path.rmdir()
+            self.parse()
+        return len(lines)
+
+    @staticmethod
+    def _move_references(css: str, old_dir: Path, new_dir: Path, moves: dict[Path, Path]) -> str:
+        """
+        Change relative urls and imports of css moved from old_dir to new_dir.
+        Targets moved too get their new paths
+        """
+        def move(m):
+            group = "ref" if m.group("ref") is not None else "ref2"
+            ref = m.group(group)
+            if ref.startswith(("/", "#", "data:")) or "://" in ref:
+                return m.group(0)
+            target = Path(os.path.normpath(old_dir / ref))
+            for x in (target, *target.parents):
+                if x in moves:
+                    target = moves[x] / target.relative_to(x)
+                    break
+            new_ref = Path(os.path.relpath(target, new_dir)).as_posix()
+            return m.group(0)[:m.start(group) - m.start()] + new_ref + m.group(0)[m.end(group) - m.start():]
+        return BEM.REFERENCE_RE.sub(move, css)
+
+    def lint(self) -> list[str]:
+        """
+        Return import lines of parsed objects that are missing in the css import file
         """
-        Print the list of requested type
+        text = self._get_imports()
+        missing = []
+        for x in self.iter_nodes():
+            missing.extend(line for line in x.get_import_lines() if line not in text)
+        return missing
+
+    def show(self, objs_type: str = "all", pattern: str | None = None, offset: int = 0,
+             limit: int | None = None, out=None) -> int:
+        """
+        Print the list of requested type.
+
+        Output is collected and written at once
         Args:
-            objs_type: block / element / modifier
+            objs_type: block / element / modifier / all
+            pattern: Glob of css names, e.g. "card__*"
+            offset: Number of matching objects to skip
+            limit: Max number of printed objects. Everything by default
+            out: Text stream. sys.stdout by default
+        Returns the number of matching objects
         """
         if objs_type == "" or objs_type == "all":
             objs_type = "block"+"element"+"modifier"
-        delimiter = " || "
+        sections = []
         if objs_type.find("block") != -1:
-            print(f"{'Blocks:':18} ", end="\t")
-            for x in self.get_blocks():
-                print(x.name, end=delimiter)
-            print()
+            sections.append(("Blocks:", self.iter_blocks()))
         if objs_type.find("element") != -1:
-            print(f"{'Elements:':18} ", end="\t")
-            for x in self.get_elements():
-                print(f"{x.ancestor.name}<-{x.name}", end=delimiter)
-            print()
+            sections.append(("Elements:", self.iter_elements()))
         if objs_type.find("modifier") != -1:
-            block_mods, element_mods = self.get_modifiers()
-            print(f"{'Block modifiers:':18} ", end="\t")
-            for x in block_mods:
-                print(f"{x.ancestor.name}<-{x.name}", end=delimiter)
-            print()
-            print(f"{'Element modifiers:':18} ", end="\t")
-            for x in element_mods:
-                print(
-                    f"{x.ancestor.ancestor.name}<-{x.ancestor.name}<-{x.name}", end=delimiter)
-            print()
+            sections.append(("Block modifiers:", self.iter_modifiers("block")))
+            sections.append(("Element modifiers:", self.iter_modifiers("element")))
+
+        delimiter = " || "
+        end = None if limit is None else offset + limit
+        parts = []
+        count = 0
+        for title, objs in sections:
+            names = []
+            for x in objs:
+                if pattern is not None and not fnmatch.fnmatchcase(x.cssName, pattern):
+                    continue
+                if count >= offset and (end is None or count < end):
+                    node, path = x, [x.name]
+                    while node.ancestor is not None:
+                        node = node.ancestor
+                        path.append(node.name)
+                    names.append("<-".join(reversed(path)))
+                count += 1
+            if names:
+                parts.append(f"{title:18} \t" + "".join(x + delimiter for x in names) + "\n")
+        (out or sys.stdout).write("".join(parts))
+        return count
 
     def parse(self, quiet: bool = True):
         """
@@ -358,13 +1370,419 @@ class BEM:
         self.blocks.clear()
         if not quiet:
             print("Parsed blocks:", end="\t")
-        for x in self.blocksDir.iterdir():
-            self.blocks.append(Block(self, x.name))
-            if not quiet:
-                print(f"{x.name}", end=" | ")
-            self.blocks[-1].parse_descendants()
+        manifest = self._load_cache("manifest")
+        if manifest.get("version") != self.MANIFEST_VERSION or manifest.get("layout") != self.layout:
+            manifest = dict()
+        self._manifest, self._manifest_new = manifest.get("modifiers", dict()), dict()
+        try:
+            with self.lock(exclusive=False):
+                for x in self.blocksDir.iterdir():
+                    self.blocks.append(Block(self, x.name))
+                    if not quiet:
+                        print(f"{x.name}", end=" | ")
+                    self.blocks[-1].parse_descendants()
+        finally:
+            modifiers = self._manifest_new
+            changed = modifiers != self._manifest
+            self._manifest = self._manifest_new = None
+        if changed:
+            self._save_cache("manifest", {"version": self.MANIFEST_VERSION, "layout": self.layout,
+                                          "modifiers": modifiers})
         if not quit:
             print()
+        self._index_rebuild()
+        self._parsed = self._transaction_depth != 0
+
+    def _relative(self, path: Path) -> str:
+        """
+        Return path related to root in posix form
+        """
+        return path.relative_to(self.rootDir).as_posix()
+
+    def to_json(self, path: Path | None = None) -> str:
+        """
+        Serialize parsed blocks and their descendants.
+
+        Could parse() before to update the model.
+        Args:
+            path: Also write the snapshot to this file
+        """
+        snapshot = {
+            "version": self.SNAPSHOT_VERSION,
+            "blocksDir": self._relative(self.blocksDir),
+            "cssFile": self._relative(self.cssFile),
+            "layout": self.layout,
+            "blocks": [x.to_dict() for x in self.blocks]
+        }
+        text = json.dumps(snapshot, separators=(",", ":"))
+        if path is not None:
+            path.write_text(text, "utf-8")
+        return text
+
+    def load_snapshot(self, snapshot: dict):
+        """
+        Replace the blocks with ones described by snapshot dict
+        """
+        self.blocks.clear()
+        for b in snapshot["blocks"]:
+            block = Block(self, b["name"])
+            block.modifiers = [Modifier(self, block, m["name"], m["values"] or None)
+                               for m in b["modifiers"]]
+            for e in b["elements"]:
+                element = Element(self, block, e["name"])
+                element.modifiers = [Modifier(self, element, m["name"], m["values"] or None)
+                                     for m in e["modifiers"]]
+                block.elements.append(element)
+            self.blocks.append(block)
+        self._index_rebuild()
+
+    def set_template(self, node_type: str, template: str):
+        """
+        Compile content template of new css files
+        Args:
+            node_type: block / element / modifier / value
+            template: Text with $cssName, $name, $block, $parent and $value.
+                Use $$ for a dollar sign
+        """
+        if node_type not in self.TEMPLATES:
+            raise ValueError(f"Unknown template type: {node_type}")
+        compiled = Template(template)
+        if not compiled.is_valid():
+            raise ValueError(f"Bad {node_type} template: {template!r}")
+        self._templates[node_type] = compiled
+        self._default_hashes.clear()
+
+    def render_template(self, obj) -> str:
+        """
+        Return the default content of object css file
+        """
+        node_type, variables = obj.get_template_vars()
+        return self._templates[node_type].safe_substitute(variables)
+
+    def default_hash(self, obj) -> bytes:
+        """
+        Return the cached hash of object default content
+        """
+        node_type, variables = obj.get_template_vars()
+        key = node_type, variables["cssName"]
+        if key not in self._default_hashes:
+            content = self._templates[node_type].safe_substitute(variables)
+            self._default_hashes[key] = hashlib.sha1(content.encode("utf-8")).digest()
+        return self._default_hashes[key]
+
+    def _load_cache(self, name: str) -> dict:
+        """
+        Read json cache file. Return empty dict if there is none
+        """
+        try:
+            return json.loads((self.cacheDir / f"{name}.json").read_text("utf-8"))
+        except (FileNotFoundError, ValueError):
+            return dict()
+
+    def _save_cache(self, name: str, data: dict):
+        """
+        Write json cache file
+        """
+        self.cacheDir.mkdir(exist_ok=True)
+        (self.cacheDir / f"{name}.json").write_text(json.dumps(data, separators=(",", ":")), "utf-8")
+
+    def _markup_files(self, src_globs=None) -> list[Path]:
+        """
+        Find markup files under the root. Hidden folders and node_modules are skipped.
+
+        The root is walked once and the skipped folders are not entered
+        Args:
+            src_globs: Glob patterns related to root. Files with MARKUP_SUFFIXES by default
+        """
+        files = set()
+        if src_globs:
+            for pattern in src_globs:
+                for x in self.rootDir.glob(pattern):
+                    parts = x.relative_to(self.rootDir).parts
+                    if "node_modules" in parts or any(p.startswith(".") for p in parts):
+                        continue
+                    if x.is_file():
+                        files.add(x)
+            return sorted(files)
+
+        for path, dirs, names in os.walk(self.rootDir):
+            dirs[:] = [x for x in dirs if x != "node_modules" and not x.startswith(".")]
+            files.update(Path(path, x) for x in names
+                         if x.endswith(self.MARKUP_SUFFIXES) and not x.startswith("."))
+        return sorted(files)
+
+    def _css_names(self) -> dict:
+        """
+        Map every css class of the model to its (object, value) pair.
+
+        Value is None for everything except the modifier values
+        """
+        names = dict()
+        for x in chain(self.iter_blocks(), self.iter_elements()):
+            names[x.cssName] = (x, None)
+        for x in self.iter_modifiers():
+            if len(x.values) == 0:
+                names[x.cssName] = (x, None)
+            for value in x.values:
+                names[f"{x.cssName}_{value}"] = (x, value)
+        return names
+
+    @staticmethod
+    def _class_pattern(names) -> str:
+        """
+        Make a single regex that matches any of the css names as a whole class.
+
+        It is applied only to class places of markup, see _class_spans()
+        """
+        alternatives = "|".join(re.escape(x) for x in sorted(names, key=len, reverse=True))
+        return rf"(?<![\w-])({alternatives})(?![\w-])"
+
+    def _run_jobs(self, func, jobs: list, workers: int | None = None) -> list:
+        """
+        Map func over jobs. Use worker processes if there are many jobs
+        """
+        if len(jobs) < self.PARALLEL_THRESHOLD or workers == 1:
+            return [func(x) for x in jobs]
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(func, jobs, chunksize=16))
+
+    def markup_classes(self, files: list[Path], workers: int | None = None, prune: bool = False) -> dict:
+        """
+        Find model css classes in every file.
+
+        Results are cached by file mtime, so only changed files are read again
+        Args:
+            files: Markup files
+            workers: Number of worker processes. Cpu count by default
+            prune: Files are all the markup, so the cache of other (deleted) files is dropped
+        Returns dict where key is file path and value is set of css names
+        """
+        names = self._css_names()
+        if len(names) == 0:
+            return {x: set() for x in files}
+        pattern = self._class_pattern(names)
+        # Scan rules are a part of the key, so their change drops the cache
+        key = hashlib.sha1((_CLASS_CONTEXT_RE.pattern + pattern).encode("utf-8")).hexdigest()
+
+        cache = self._load_cache("usage")
+        cached = cache.get("files", dict()) if cache.get("pattern") == key else dict()
+
+        result = dict()
+        todo = []
+        stats = dict()
+        for x in files:
+            st = x.stat()
+            stats[x] = [st.st_mtime_ns, st.st_size]
+            entry = cached.get(str(x))
+            if entry is not None and entry[:2] == stats[x]:
+                result[x] = set(entry[2])
+            else:
+                todo.append(x)
+
+        found = self._run_jobs(_scan_markup, [(str(x), pattern) for x in todo], workers)
+        for x, classes in zip(todo, found):
+            result[x] = set(classes)
+
+        if prune:
+            cached = dict()
+        cached.update({str(x): stats[x] + [sorted(result[x])] for x in files})
+        self._save_cache("usage", {"pattern": key, "files": cached})
+        return result
+
+    def usage(self, src_globs=None, workers: int | None = None) -> dict:
+        """
+        Find the objects which css classes are not used in markup files.
+
+        Could parse() before to update the model.
+        Args:
+            src_globs: Glob patterns of markup files related to root
+            workers: Number of worker processes
+        Returns dict with lists of unused "block", "element", "modifier"
+        and "value" (pairs of modifier and value)
+        """
+        used = set()
+        for classes in self.markup_classes(self._markup_files(src_globs), workers, prune=True).values():
+            used |= classes
+
+        unused = {"block": [], "element": [], "modifier": [], "value": []}
+        for name, (obj, value) in self._css_names().items():
+            if name in used:
+                continue
+            if value is None:
+                unused[obj.type].append(obj)
+            else:
+                unused["value"].append((obj, value))
+
+        # Valued modifier is unused if none of its values is used
+        for x in self.iter_modifiers():
+            if len(x.values) != 0 and all(f"{x.cssName}_{v}" not in used for v in x.values):
+                unused["modifier"].append(x)
+        return unused
+
+    def rewrite_markup(self, mapping: dict, src_globs=None, workers: int | None = None) -> int:
+        """
+        Replace css classes in markup files
+        Args:
+            mapping: Old css name to new css name dict
+            src_globs: Glob patterns of markup files related to root
+            workers: Number of worker processes
+        Returns the number of changed files
+        """
+        if len(mapping) == 0:
+            return 0
+        pattern = self._class_pattern(mapping)
+        jobs = [(str(x), pattern, mapping) for x in self._markup_files(src_globs)]
+        return sum(self._run_jobs(_rewrite_markup, jobs, workers))
+
+    def import_order(self) -> list[Path]:
+        """
+        Return the files imported by css import file in order. Urls are skipped
+        """
+        files = []
+        for x in self.IMPORT_RE.findall(self._get_imports()):
+            if "://" not in x and not x.startswith("//"):
+                files.append((self.cssFile.parent / x).resolve())
+        return files
+
+    def import_graph(self) -> "ImportGraph":
+        """
+        Return the graph of css import file and nested @import statements
+        """
+        return ImportGraph(self.cssFile)
+
+    def _strip_imports(self, css: str) -> str:
+        """
+        Remove local @import statements. Their files are inlined by build()
+        """
+        def strip(m):
+            x = m.group(1)
+            return m.group(0) if "://" in x or x.startswith("//") else ""
+        return self.IMPORT_RE.sub(strip, css)
+
+    def build(self, out: Path | None = None, minify: bool = True) -> Path:
+        """
+        Concatenate imported files in cascade order. Nested imports are inlined.
+
+        Minified files are cached by content hash. Unchanged files are not even read
+        Args:
+            out: Result file. index.min.css (or index.bundle.css) beside the css import file by default
+            minify: Strip comments and whitespace, drop empty rules
+        Returns the result file path
+        """
+        if out is None:
+            out = self.cssFile.with_name(self.cssFile.stem + (".min.css" if minify else ".bundle.css"))
+
+        graph = self.import_graph()
+        for x in graph.missing:
+            print(f"Warning! {x} is imported but doesn't exist")
+        self._bundle([x for x in graph.order() if x != graph.root and x not in graph.missing], out, minify,
+                     graph.wrappers())
+        return out
+
+    def _bundle(self, files: list[Path], out: Path, minify: bool, wrappers: dict[Path, list[str]] | None = None):
+        """
+        Write files content to out. Local @imports are stripped, see build()
+        Args:
+            wrappers: At-rules that keep the conditions of the stripped imports. See ImportGraph.wrappers()
+        """
+        wrappers = wrappers or dict()
+        cache = self._load_cache("minify") if minify else dict()
+        stats = cache.get("files", dict())
+        minified = cache.get("min", dict())
+        parts = []
+        for x in files:
+            if not minify:
+                parts.append(self._wrap(self._strip_imports(x.read_text("utf-8")), wrappers.get(x), "\n"))
+                continue
+
+            st = x.stat()
+            entry = stats.get(str(x))
+            if entry is not None and entry[:2] == [st.st_mtime_ns, st.st_size] and entry[2] in minified:
+                digest = entry[2]
+            else:
+                css = x.read_text("utf-8")
+                digest = hashlib.sha1(css.encode("utf-8")).hexdigest()
+                if digest not in minified:
+                    minified[digest] = _minify_css(self._strip_imports(css))
+                stats[str(x)] = [st.st_mtime_ns, st.st_size, digest]
+            parts.append(self._wrap(minified[digest], wrappers.get(x), ""))
+
+        if minify:
+            # Keep the minified content of every known file, so page bundles don't evict the build ones
+            digests = {x[2] for x in stats.values()}
+            self._save_cache("minify", {"files": stats, "min": {k: v for k, v in minified.items() if k in digests}})
+        self.write_css(out, ("" if minify else "\n").join(x for x in parts if x))
+
+    @staticmethod
+    def _wrap(css: str, rules: list[str] | None, sep: str) -> str:
+        """
+        Nest css in the at-rules of its import conditions. Empty css is not wrapped
+        """
+        if not rules or not css.strip():
+            return css
+        if not sep:
+            return "".join(f"{x}{{" for x in rules) + css + "}" * len(rules)
+        return "".join(f"{x} {{\n" for x in rules) + css.strip("\n") + "\n}" * len(rules) + "\n"
+
+    def emit_for(self, html_paths: list[Path], out: Path | None = None, bundle: bool = False,
+                 minify: bool = False) -> Path:
+        """
+        Write css of the objects that markup files use only.
+
+        Classes of the files are found by markup_classes(), so unchanged files are not read again.
+        Files go in the css import file order, the not imported ones go after them
+        Args:
+            html_paths: Markup files of the page
+            out: Result file. <page>.page.css beside the css import file by default
+            bundle: Write css content (nested imports inlined) instead of import lines
+            minify: Minify the bundle
+        Returns the result file path
+        Raises ValueError if there are no markup files and no result file to name after them
+        """
+        html_paths = [Path(x) for x in html_paths]
+        if not html_paths and out is None:
+            raise ValueError("No markup files. Give html_paths or the out file")
+        if out is None:
+            suffix = ".page.css" if not bundle else ".page.min.css" if minify else ".page.bundle.css"
+            out = self.cssFile.with_name(html_paths[0].stem + suffix)
+
+        used = set()
+        for classes in self.markup_classes(html_paths).values():
+            used |= classes
+
+        # Css file and import line of every used class
+        entries = dict()
+        for name, (obj, value) in self._css_names().items():
+            if name not in used:
+                continue
+            for x in obj.get_css_entries():
+                if x[0] == value:
+                    entries.setdefault(x[1].resolve(), x[2])
+
+        order = self.import_order()
+        imported = set(order)
+        files = [x for x in order if x in entries]
+        files.extend(x for x in entries if x not in imported)
+
+        if bundle:
+            graph = self.import_graph()
+            for x in files:
+                if x not in imported:
+                    graph.update(x)
+            needed = graph.closure(files)
+            # Cascade order of the needed files and the files they import
+            cascade = [x for x in graph.order() if x in needed]
+            cascade.extend(x for x in files if x not in cascade)
+            self._bundle([x for x in cascade if x not in graph.missing], out, minify, graph.wrappers())
+            return out
+
+        lines = []
+        for x in files:
+            line = entries[x]
+            old = os.path.relpath(x, self.cssFile.parent.resolve())
+            lines.append(line.replace(f'"{old}"', f'"{os.path.relpath(x, out.parent.resolve())}"'))
+        self.write_css(out, "".join(lines))
+        return out
 
     def make_obj(self, obj_type: str, obj_name: str, ancestor=None, values=None):
         """
@@ -386,91 +1804,604 @@ class BEM:
 
         return obj
 
-    @staticmethod
-    def launch_editor(obj, editor: str = "code"):
+    @contextmanager
+    def transaction(self):
         """
-        Start editing the obj css file
+        Group operations. Delayed work is done when the outermost transaction ends
+
+        Import file is read once and written once if it is changed.
+        skipped_writes counts the unchanged writes of the whole transaction.
+        fix_imports() parses only if nothing was parsed yet.
+        Editor launches are coalesced into one process per editor.
+        Editors and event hooks are called after the lock is released.
+
+        An error inside doesn't roll back: the files changed before it stay, and the import lines
+        of the finished operations are written with one backup of the previous contents.
+        restore() brings index.css and the rewritten files back, files created before the error are left
+        """
+        outermost = self._transaction_depth == 0
+        if outermost:
+            self.skipped_writes = 0
+        try:
+            # Lock is taken before the import file is loaded and released after it is written
+            with self.lock():
+                self._transaction_depth += 1
+                try:
+                    yield self
+                finally:
+                    self._transaction_depth -= 1
+                    if outermost:
+                        self._end_transaction()
+        finally:
+            if outermost:
+                self._notify()
+
+    @contextmanager
+    def lock(self, exclusive: bool = True):
+        """
+        Hold the project advisory lock shared with other processes.
+
+        Readers share the lock, a writer holds it alone.
+        Nested calls reuse the held lock. A shared lock is not upgraded, since flock() would release it
+        in between and the data read under it could be changed. Writers take the exclusive lock first.
+        Does nothing where fcntl is missing
+        Args:
+            exclusive: Lock for writing
+        Raises RuntimeError for an exclusive call inside of a shared one
+        """
+        if fcntl is None:
+            yield self
+            return
+
+        held = self._lock_modes[-1] if self._lock_modes else None
+        if exclusive and held == fcntl.LOCK_SH:
+            raise RuntimeError("Shared project lock can't be upgraded. Take the exclusive lock first")
+        mode = held or (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        if self._lock_fd is None:
+            self.cacheDir.mkdir(exist_ok=True)
+            self._lock_fd = os.open(self.cacheDir / "lock", os.O_RDWR | os.O_CREAT, 0o644)
+        if mode != held:
+            fcntl.flock(self._lock_fd, mode)
+        self._lock_modes.append(mode)
+        try:
+            yield self
+        finally:
+            self._lock_modes.pop()
+            if not self._lock_modes:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    def _end_transaction(self):
+        """
+        Do the work delayed by transaction()
+        """
+        edits = self._import_edits
+        if edits is not None and (not edits.changed or edits.same(self.IMPORT_CHUNK)):
+            edits.close()
+            self._import_edits = None
+        if self._imports_changed:
+            if self._import_edits is not None:
+                self._write_imports(self._import_edits)
+            elif self._import_text is None:
+                self.skipped_writes += 1
+            elif self._import_text == self._import_loaded:
+                self.skipped_writes += 1
+            else:
+                self._snapshot(self.cssFile)
+                with open(self.cssFile, "w", encoding="utf-8", newline=self._import_newline()) as f:
+                    f.write(self._import_text)
+        self._save_backup()
+        self._import_text = None
+        self._import_loaded = None
+        self._import_edits = None
+        self._imports_changed = False
+        self._parsed = False
+
+    def _notify(self):
+        """
+        Launch editors and call event hooks of the ended transaction.
+
+        A callback gets its events in the order they happened, even if it is set for several event types
+        """
+        queue, self._editor_queue = self._editor_queue, dict()
+        for editor, files in queue.items():
+            self._launch(editor, files)
+
+        events, self._events = self._events, []
+        calls = dict()
+        for x in events:
+            for callback in self._hooks[x["event"]]:
+                calls.setdefault(callback, []).append(x)
+        for callback, batch in calls.items():
+            callback(batch)
+
+    def on(self, event: str, callback):
+        """
+        Call callback with the list of events of a transaction when it ends.
+
+        Events are in the order they happened. A callback set for several events gets all of them in one list,
+        so a removal and a creation of the same object keep their order.
+        Event is a dict with "event", "type", "name", "cssName", "value" (modifier value or None),
+        "path" (css file) and "imports" (import lines).
+        Renamed events also have "old_name", "old_cssName", "old_path" and "old_imports".
+        A rename sends one renamed event, not the removed and created ones it is made of
+        Args:
+            event: One of EVENTS
+            callback: Function of the events list
+        """
+        if event not in self.EVENTS:
+            raise ValueError(f"Unknown event: {event}")
+        self._hooks[event].append(callback)
+
+    def off(self, event: str, callback):
+        """
+        Stop calling callback set by on()
+        """
+        if event not in self.EVENTS:
+            raise ValueError(f"Unknown event: {event}")
+        if callback in self._hooks[event]:
+            self._hooks[event].remove(callback)
+
+    def _emit(self, event: dict):
+        """
+        Queue event till the transaction end
+        """
+        if self._event_capture is not None:
+            self._event_capture.append(event)
+        else:
+            self._events.append(event)
+
+    @contextmanager
+    def _capture_events(self):
+        """
+        Collect events into the yielded list instead of sending them
+        """
+        outer, self._event_capture = self._event_capture, []
+        try:
+            yield self._event_capture
+        finally:
+            self._event_capture = outer
+
+    def _launch(self, editor: str, files: list[Path]):
+        """
+        Start editor process with files. Don't wait for it
+        """
+        try:
+            subprocess.Popen(shlex.split(editor) + [str(x) for x in files],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            print(f"Can't launch {editor}:", e)
+
+    def launch_editor(self, obj, editor: str | None = None):
+        """
+        Start editing the obj css files.
+
+        Inside of transaction() the files are opened when it ends
         :param obj: Instance of object
-        :param editor: Not implemented. Vs code is default
+        :param editor: Editor command. self.editor is default
         """
-        os.system(f"code {obj.cssFile}")
+        files = self._editor_queue.setdefault(editor or self.editor, [])
+        files.extend(x for x in obj.get_css_files() if x not in files)
+        if self._transaction_depth == 0:
+            self._notify()
 
-    def create(self, obj_type: str, obj_name: str, ancestor=None, values=None):
+    def _make_existing_obj(self, obj_type: str, obj_name: str, ancestor=None, values=None):
         """
-        Make a new object. Create file and add import css
+        Make an object that is already created.
+
+        Modifier values are parsed if they are not given
         """
         obj = self.make_obj(obj_type, obj_name, ancestor, values)
-        obj.create()
+        if obj_type == "modifier" and values is None and obj.exists():
+            obj.parse_values()
+        return obj
 
-        if obj_type == "block":
-            self.blocks.append(obj)
+    def _check_name(self, name: str, layout: str | None = None):
+        """
+        Raise ValueError for a name the layout can't parse back.
+
+        Flat layout splits file names by "_", so "card__big_title.css" could be a modifier of "big"
+        """
+        if (layout or self.layout) == "flat" and "_" in name.lstrip("_"):
+            raise ValueError(f"Name {name} can't contain \"_\" in the flat layout")
+
+    def create(self, obj_type: str, obj_name: str, ancestor=None, values=None):
+        """
+        Make a new object. Create file and add import css
+        Returns the object
+        """
+        self._check_name(obj_name)
+        with self.transaction():
+            obj = self.make_obj(obj_type, obj_name, ancestor, values)
+            obj.create()
+            self._model_add(obj)
 
-        if self.autolaunch:
-            self.launch_editor(obj)
+            if self.autolaunch:
+                self.launch_editor(obj)
+        return obj
 
-    def remove(self, obj_type: str, obj_name: str, ancestor=None, values=None):
+    def remove(self, obj_type: str, obj_name: str, ancestor=None, values=None, force: bool = False):
         """
         Remove file and import from css
+
+        Ask for confirmation unless force is true
+        Returns true if the object was removed
         """
-        obj = self.make_obj(obj_type, obj_name, ancestor, values)
-        res = obj.remove()
-        if res:
-            if obj_type == "block":
-                self._remove_block(obj_name)
+        obj = self._make_existing_obj(obj_type, obj_name, ancestor, values)
+        if not obj._confirm_remove(force):
+            return False
+        with self.transaction():
+            res = obj.remove(True)
+            if res:
+                self._model_remove(obj)
+        return res
 
-    def rename(self, new_name: str, obj_type: str, obj_name: str, ancestor=None, values=None):
+    def rename(self, new_name: str, obj_type: str, obj_name: str, ancestor=None, values=None,
+               markup: bool = False):
         """
         Rename file and change css import
+
+        Also replace classes in markup files if markup is true
+        Returns the object
         """
-        obj = self.make_obj(obj_type, obj_name, ancestor, values)
-        obj.rename(new_name)
+        self._check_name(new_name)
+        with self.transaction():
+            obj = self._make_existing_obj(obj_type, obj_name, ancestor, values)
+            old_name = obj.name
+            obj.rename(new_name, markup)
+            self._model_remove(obj, old_name)
+            self._model_add(obj)
+        return obj
+
+    def clone(self, block_name: str, new_name: str) -> "Block":
+        """
+        Copy the block with its descendants and css as a new block. See Block.clone
+        Returns the new block
+        """
+        self._check_name(new_name)
+        with self.transaction():
+            block = Block(self, block_name).clone(new_name)
+            self._model_add(block)
+        return block
+
+    def _content_hash(self, path: Path) -> bytes | None:
+        """
+        Return hash of css file content. Read the file only if it was changed since the last time
+        """
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        entry = self._hashes.get(path)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            return entry[2]
+        return self._remember(path, hashlib.sha1(path.read_text("utf-8").encode("utf-8")).digest())
+
+    def _remember(self, path: Path, digest: bytes) -> bytes:
+        """
+        Save content hash of the css file with its current mtime and size
+        """
+        st = path.stat()
+        self._hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def read_css(self, path: Path) -> str:
+        """
+        Read css file and remember its hash
+        """
+        text = path.read_text("utf-8")
+        self._remember(path, hashlib.sha1(text.encode("utf-8")).digest())
+        return text
+
+    def write_css(self, path: Path, text: str) -> bool:
+        """
+        Write css file if its content would change
+        Returns false if the write was skipped
+        """
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        if self._content_hash(path) == digest:
+            self.skipped_writes += 1
+            return False
+        if path.is_relative_to(self.blocksDir):
+            self._snapshot(path)
+        path.write_text(text, "utf-8")
+        self._remember(path, digest)
+        return True
+
+    def _get_imports(self) -> str:
+        """
+        Read css import file. Inside of transaction it is read once.
+
+        Only the whole file operations need the text. Line changes are kept by _edits() till then
+        """
+        if self._transaction_depth != 0 and self._import_text is not None:
+            return self._import_text
+        with self.lock(exclusive=False):
+            with open(self.cssFile, "r", encoding="utf-8") as f:
+                text = f.read()
+            if self._transaction_depth == 0:
+                return text
+            self._import_loaded = text
+            if self._import_edits is not None:
+                if self._import_edits.changed:
+                    buffer = io.BytesIO()
+                    self._import_edits.stream(buffer.write, self.IMPORT_CHUNK)
+                    text = buffer.getvalue().decode("utf-8").replace("\r\n", "\n")
+                self._import_edits.close()
+                self._import_edits = None
+            self._import_text = text
+        return text
+
+    def _set_imports(self, text: str):
+        """
+        Write css import file. Inside of transaction it is written when it ends
+        """
+        if self._transaction_depth != 0:
+            self._import_text = text
+            if self._import_edits is not None:
+                self._import_edits.close()
+                self._import_edits = None
+            self._imports_changed = True
+        else:
+            with self.lock():
+                self._snapshot(self.cssFile)
+                with open(self.cssFile, "w", encoding="utf-8", newline=self._import_newline()) as f:
+                    f.write(text)
+
+    def _import_newline(self) -> str:
+        """
+        Return line break of the css import file. "\n" if it has no lines yet
+        """
+        with open(self.cssFile, "rb") as f:
+            head = f.read(self.IMPORT_CHUNK)
+        i = head.find(b"\n")
+        return "\r\n" if i > 0 and head[i - 1:i] == b"\r" else "\n"
+
+    def _edits(self) -> _ImportEdits:
+        """
+        Return import file changes of the transaction. It ends them
+        """
+        if self._import_edits is None:
+            self._import_edits = _ImportEdits(self.cssFile)
+        return self._import_edits
+
+    def _write_imports(self, edits: _ImportEdits):
+        """
+        Stream the changed css import file into a new file which replaces the old one. Edits are closed
+        """
+        self._snapshot(self.cssFile)
+        tmp = self.cssFile.with_name(self.cssFile.name + ".tmp")
+        with edits, open(tmp, "wb") as out:
+            edits.stream(out.write, self.IMPORT_CHUNK)
+        shutil.copymode(self.cssFile, tmp)
+        os.replace(tmp, self.cssFile)
 
     def append_import(self, line: str):
         """
         Add line to the end of css file
         """
+        if self._transaction_depth != 0:
+            if self._import_text is not None:
+                self._set_imports(self._import_text + line)
+            else:
+                self._edits().append(line)
+                self._imports_changed = True
+            return
 
-        with open(self.cssFile, "a") as f:
+        with self.lock(), open(self.cssFile, "a", encoding="utf-8", newline=self._import_newline()) as f:
             f.write(line)
 
     def make_import_backup(self) -> Path:
         """
-        Just copy main css file in case
+        Save css import file to the store
+        Returns the stored copy path
+        """
+        return self._blob(self._snapshot(self.cssFile))
+
+    def _blob(self, digest: str) -> Path:
+        """
+        Return the store file of content hash
+        """
+        return self.storeDir / "objects" / digest[:2] / digest[2:]
+
+    def _store_file(self, path: Path) -> str | None:
+        """
+        Copy file content to the store unless it is there.
+
+        The file is hashed and copied by chunks. It is not read again while it is unchanged
+        Returns the content hash or None if there is no file
+        """
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        entry = self._stored.get(path)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size) and self._blob(entry[2]).exists():
+            return entry[2]
+
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha1").hexdigest()
+            blob = self._blob(digest)
+            if not blob.exists():
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                tmp = blob.with_name(blob.name + ".tmp")
+                f.seek(0)
+                with open(tmp, "wb") as out:
+                    shutil.copyfileobj(f, out, self.IMPORT_CHUNK)
+                os.replace(tmp, blob)
+        self._stored[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def _snapshot(self, path: Path) -> str | None:
+        """
+        Save file content before it is rewritten or deleted.
+
+        A transaction makes one backup with the first content of every file
+        Returns the content hash or None if there is no file
+        """
+        if self._backup is None:
+            self._backup = dict()
+        key = self._relative(path)
+        digest = self._backup.get(key)
+        if digest is None:
+            digest = self._store_file(path)
+            if digest is not None:
+                self._backup[key] = digest
+        if self._transaction_depth == 0:
+            self._save_backup()
+        return digest
+
+    def _save_backup(self):
+        """
+        Write the backup made by _snapshot() calls and drop the old ones
+        """
+        files, self._backup = self._backup, None
+        if not files:
+            return
+        records = self.storeDir / "records"
+        records.mkdir(parents=True, exist_ok=True)
+        records.joinpath(f"{time.time_ns()}.json").write_text(json.dumps({"files": files}, indent=1), "utf-8")
+        self._prune_store()
+
+    def _backup_files(self) -> list[Path]:
+        """
+        Return backup record files from old to new
+        """
+        records = self.storeDir / "records"
+        if not records.exists():
+            return []
+        return sorted(records.glob("*.json"), key=lambda x: int(x.stem))
+
+    def _load_refs(self, records: list[Path]) -> dict[str, int]:
+        """
+        Return the number of backup records that refer to every stored content.
+
+        refs.json keeps the counts up to a record, only the newer records are read.
+        A missing or broken index is made from every record
+        """
+        try:
+            index = json.loads(self.storeDir.joinpath("refs.json").read_text("utf-8"))
+            upto, refs = index["upto"], index["refs"]
+        except (FileNotFoundError, ValueError, KeyError):
+            upto, refs = -1, dict()
+        for x in records:
+            if int(x.stem) > upto:
+                for digest in set(json.loads(x.read_text("utf-8"))["files"].values()):
+                    refs[digest] = refs.get(digest, 0) + 1
+        return refs
+
+    def _prune_store(self):
+        """
+        Keep backup_keep newest backups and the contents they refer to.
+
+        Only the new and the dropped records are read, see _load_refs().
+        The index is written last, so an interrupted prune can leak contents but never drop the used ones
+        """
+        records = self._backup_files()
+        if self.backup_keep == 0 or len(records) <= self.backup_keep:
+            return
+        refs = self._load_refs(records)
+        for x in records[:-self.backup_keep]:
+            digests = set(json.loads(x.read_text("utf-8"))["files"].values())
+            x.unlink()
+            for digest in digests:
+                refs[digest] = refs.get(digest, 1) - 1
+                if refs[digest] <= 0:
+                    del refs[digest]
+                    self._blob(digest).unlink(missing_ok=True)
+        self.storeDir.joinpath("refs.json").write_text(
+            json.dumps({"upto": int(records[-1].stem), "refs": refs}), "utf-8")
+        self._stored = {k: v for k, v in self._stored.items() if v[2] in refs}
+
+    def backups(self) -> list[dict]:
+        """
+        Return backups from new to old.
+
+        Backup is a dict with "id", "time" (seconds since epoch) and "files" (related path to content hash)
+        """
+        result = []
+        for x in reversed(self._backup_files()):
+            files = json.loads(x.read_text("utf-8"))["files"]
+            result.append({"id": x.stem, "time": int(x.stem) / 1e9, "files": files})
+        return result
+
+    def restore(self, backup_id: str | None = None, paths: list[Path] | None = None) -> list[Path]:
         """
-        css_copy = Path(__file__).parent / self.cssFile.name
-        shutil.copyfile(self.cssFile, css_copy)
-        css_copy = css_copy.rename(css_copy.with_suffix(".css.old"))
-        return css_copy
+        Write files back from a backup. Current contents are backed up before.
+
+        The model is parsed again
+        Args:
+            backup_id: Backup "id". The newest by default
+            paths: Files to be restored. All files of the backup by default
+        Returns restored files
+        """
+        backups = self.backups()
+        backup = next((x for x in backups if backup_id in (None, x["id"])), None)
+        if backup is None:
+            raise FileNotFoundError(f"No backup {backup_id or ''}".strip())
+        keys = backup["files"].keys() if paths is None else [self._relative(Path(x)) for x in paths]
+
+        restored = []
+        with self.transaction():
+            for key in keys:
+                if key not in backup["files"]:
+                    raise FileNotFoundError(f"Backup {backup['id']} has no {key}")
+                path = self.rootDir / key
+                text = self._blob(backup["files"][key]).read_text("utf-8")
+                if path == self.cssFile:
+                    self._set_imports(text)
+                else:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    self.write_css(path, text)
+                restored.append(path)
+            self.parse()
+        return restored
 
     def has_import(self, line: str) -> bool:
         """
-        Check import file
+        Check import file.
+
+        The file is memory-mapped, so it is not decoded and loaded as a whole
         Args:
             line: Line that will be found in the css import file
         """
-        with open(self.cssFile, "r") as f:
-            text = f.read()
-            return text.find(line) != -1
+        if self._transaction_depth != 0 and self._import_text is not None:
+            return self._import_text.find(line) != -1
+        if self._transaction_depth != 0:
+            return self._edits().find(line) is not None
+        with self.lock(exclusive=False), _ImportEdits(self.cssFile) as edits:
+            return edits.find(line) is not None
 
     def remove_import(self, line: str):
         """
         Open css file and delete line.
 
-        Also delete comment before it.
-        Be sure to keep the script proposed formatting.
+        Ranges around the line are copied by chunks into a new file. Inside of transaction it is done when it ends
+        Raises ValueError if there is no such line
         """
         # Backup css import file
         # Don't think it is neccesary
         # self.make_import_backup()
 
-        # Remove line and commenting line before it if possible
-        with open(self.cssFile, "r") as f:
-            text = f.read()
+        if self._transaction_depth != 0 and self._import_text is not None:
+            text = self._import_text
             # Raises ValueError if cssFile has no such line
             ind = text.index(line)
-            new_text = text[:ind] + text[ind+len(line):]
-        with open(self.cssFile, "w") as f:
-            f.write(new_text)
+            self._set_imports(text[:ind] + text[ind+len(line):])
+            return
+
+        if self._transaction_depth != 0:
+            if not self._edits().replace({line: ""}):
+                raise ValueError(f"{self.cssFile} has no line {line!r}")
+            self._imports_changed = True
+            return
+
+        with self.lock(), _ImportEdits(self.cssFile) as edits:
+            if not edits.replace({line: ""}):
+                raise ValueError(f"{self.cssFile} has no line {line!r}")
+            self._write_imports(edits)
 
 
 class _BEMGen:
@@ -491,7 +2422,7 @@ class _BEMGen:
         self.cssName = ""                   # CSS class name
         self.path = Path()                  # Absolute path to object location
         self.cssFile = Path()               # Abs path to object's css file
-        self.css = ""                       # CSS code. Not live time
+        self.css = None                     # CSS code. Not live time. None gets the template
 
         # Set the mentioned vars
         self.update_name(name)
@@ -515,8 +2446,47 @@ class _BEMGen:
         """
         Check creation and removal possibility
         """
+        if self.BEM.layout == "flat" and self.ancestor is not None:
+            return self.cssFile.exists()
         return self.path.exists()
 
+    def get_css_entries(self) -> list[tuple]:
+        """
+        Return (value, css file, import line) of every object css file.
+
+        Value is None for everything except the modifier values
+        """
+        return [(None, self.cssFile, self.build_import_line())]
+
+    def _flat_suffixes(self, prefix: str) -> list[str]:
+        """
+        Return names of the block folder css files that start with prefix.
+
+        Prefix and extension are cut. Used by the flat layout
+        """
+        if not self.path.exists():
+            return []
+        with os.scandir(self.path) as it:
+            return sorted(x.name[len(prefix):-4] for x in it
+                          if x.name.startswith(prefix) and x.name.endswith(".css") and x.is_file())
+
+    def _flat_modifiers(self, suffixes: list[str]) -> list:
+        """
+        Make modifiers from flat file names like "size_s" or "hidden".
+
+        Suffixes of elements (starting with "_") are skipped
+        """
+        modifiers = dict()
+        for x in suffixes:
+            if x.startswith("_"):
+                continue
+            name, _, value = x.partition("_")
+            if name not in modifiers:
+                modifiers[name] = Modifier(self.BEM, self, name)
+            if value:
+                modifiers[name].values.append(value)
+        return list(modifiers.values())
+
     def build_import_line(self) -> str:
         """
         Construct lines used as css import
@@ -532,12 +2502,26 @@ class _BEMGen:
 
         return line
 
+    def get_template_vars(self) -> tuple[str, dict]:
+        """
+        Return template type and variables of the object
+        """
+        block = self
+        while block.ancestor is not None:
+            block = block.ancestor
+        return self.type, {
+            "cssName": self.cssName,
+            "name": self.name,
+            "block": block.cssName,
+            "parent": self.ancestor.cssName if self.ancestor else "",
+            "value": ""
+        }
+
     def get_default_content(self) -> str:
         """
         Make a string that is written to BEM object's css file.
         """
-        content = ".%s {\n\t\n}\n" % self.cssName
-        return content
+        return self.BEM.render_template(self)
 
     def _get_remove_permission(self) -> bool:
         """
@@ -547,25 +2531,39 @@ class _BEMGen:
         """
         if self.cssFile.exists():
             content = self.cssFile.read_text("utf-8")
-            if content != self.get_default_content():
+            if hashlib.sha1(content.encode("utf-8")).digest() != self.BEM.default_hash(self):
                 print(f"{self.name} css content is changed: ")
                 width = shutil.get_terminal_size().columns  # Get terminal width dynamically
                 file_name = f"[{self.cssFile.name}]"
                 print(f"FILE {file_name.center(width - 5, "-")}")
-                print(self.cssFile.read_text("utf-8"))
+                print(content)
                 print("ENDFILE".rjust(width, "-"))
 
-        print(f"{self.name} has {len(list(self.path.iterdir()))} objects inside")
+        if self.BEM.layout == "flat" and self.ancestor is not None:
+            inside = len(self._flat_suffixes(self.cssName + "_"))
+        else:
+            inside = len(list(self.path.iterdir()))
+        print(f"{self.name} has {inside} objects inside")
         answer = input("Is it okay to remove? Type \"yes\": ")
         if answer.strip().lower() == "yes":
             return True
 
         return False
 
+    def _confirm_remove(self, force: bool) -> bool:
+        """
+        Ask removal permission unless force is true. See _confirmed()
+
+        Missing objects are not asked about, their removal raises an error
+        """
+        return force or not self.exists() or self._get_remove_permission()
+
     def get_descendant_modifiers(self) -> list:
         """
         Find object modifiers.
         """
+        if self.BEM.layout == "flat":
+            return self._flat_modifiers(self._flat_suffixes(self.cssName + "_"))
         modifiers = []
         for x in self.path.glob("_[!_]*"):
             modifiers.append(Modifier(self.BEM, self, x.name))
@@ -576,19 +2574,20 @@ class _BEMGen:
         """
         Make css file and import
         """
-        if self.exists():
+        if self.path.exists():
             if self.cssFile.exists():
                 self.error(FileExistsError(f"{self.cssFile} already exists!"))
             else:
-                if self.css == "":
+                if self.css is None:
                     content = self.get_default_content()
                 else:
                     content = self.css
 
                 # Write content to object css
-                self.cssFile.write_text(content, "utf-8")
+                self.BEM.write_css(self.cssFile, content)
                 # Import it to main css file
                 self.BEM.append_import(self.build_import_line())
+                self.BEM._emit(self._event("created"))
         else:
             self.error(FileNotFoundError(f"Cannot find {self.path}"))
 
@@ -605,9 +2604,10 @@ class _BEMGen:
             self.warning(f"{self.type} already exists!")
             self._create_resolve_css()      # Add css file
         else:
-            self.path.mkdir()               # Create block folder
+            self.path.mkdir(exist_ok=True)  # Create object folder. Flat layout shares the block one
             if not nocss:
                 self._create_resolve_css()  # Add css file
+        self.BEM._index_add(self)
 
     def _remove(self, force: bool = False) -> bool:
         """
@@ -627,6 +2627,7 @@ class _BEMGen:
             # Ask for permission and remove the directory
             if force or self._get_remove_permission():
                 # Remove css file
+                self.BEM._snapshot(self.cssFile)
                 self.cssFile.unlink()
                 # Remove folder if possible
                 if self.path.exists():
@@ -639,6 +2640,9 @@ class _BEMGen:
                         pass
                 # Remove import from cssFile
                 self.BEM.remove_import(self.build_import_line())
+                self.BEM._emit(self._event("removed"))
+                if not self.exists():
+                    self.BEM._index_remove(self)
                 return True
         return False
 
@@ -651,6 +2655,76 @@ class _BEMGen:
         self.name = new_name
         self.cssFile = self.path / f"{self.cssName}.css"
 
+    def to_dict(self) -> dict:
+        """
+        Return the object as a snapshot entry
+        """
+        return {
+            "name": self.name,
+            "cssName": self.cssName,
+            "path": self.BEM._relative(self.path)
+        }
+
+    def _event(self, event: str) -> dict:
+        """
+        Describe the object css file for the hooks. See BEM.on()
+        """
+        return {
+            "event": event,
+            "type": self.type,
+            "name": self.name,
+            "cssName": self.cssName,
+            "value": getattr(self, "_value", None),
+            "path": self.cssFile,
+            "imports": [self.build_import_line()]
+        }
+
+    def get_events(self, event: str) -> list[dict]:
+        """
+        Describe every object css file for the hooks
+        """
+        return [self._event(event)]
+
+    @contextmanager
+    def _renaming(self):
+        """
+        Send one renamed event instead of the removed and created ones made inside.
+
+        If renaming fails, the events are sent as they are
+        """
+        old = self._event("renamed")
+        try:
+            with self.BEM._capture_events() as inner:
+                yield
+        except BaseException:
+            for x in inner:
+                self.BEM._emit(x)
+            raise
+        if len(inner) != 0:
+            self.BEM._emit(self._renamed_event(
+                old,
+                sum((x["imports"] for x in inner if x["event"] == "removed"), []),
+                sum((x["imports"] for x in inner if x["event"] == "created"), [])
+            ))
+
+    def _renamed_event(self, old: dict, old_imports: list[str], imports: list[str]) -> dict:
+        """
+        Make renamed event of the current object state
+        Args:
+            old: _event() made before renaming
+            old_imports: Removed import lines
+            imports: Added import lines
+        """
+        event = self._event("renamed")
+        event.update({
+            "old_name": old["name"],
+            "old_cssName": old["cssName"],
+            "old_path": old["path"],
+            "old_imports": old_imports,
+            "imports": imports
+        })
+        return event
+
     def get_conf(self) -> list:
         """
         Return the state of object
@@ -698,12 +2772,18 @@ class _BEMGen:
         Read cssFile and return it
         """
         if self.cssFile.exists():
-            css = self.cssFile.read_text("utf-8")
+            css = self.BEM.read_css(self.cssFile)
             return css
         else:
             self.error(FileNotFoundError(f"Can't read {self.cssFile}"))
             return "error"
 
+    def get_import_lines(self) -> list[str]:
+        """
+        Return css import lines of the object
+        """
+        return [self.build_import_line()]
+
     def update_import_line(self) -> int:
         """
         Try to remove old and paste a new css import line
@@ -729,16 +2809,42 @@ class _BEMGen:
         # Replace should be changed to parser
         return new_css
 
-    def set_css(self, new_css: str):
+    def get_css_names(self) -> list[str]:
+        """
+        Return css names of the object and its known descendants
+        """
+        return [self.cssName]
+
+    def get_css_files(self) -> list[Path]:
+        """
+        Return css files of the object and its known descendants
+        """
+        return [self.cssFile]
+
+    def _rename_markup(self, old_css_name: str, old_names: list[str]) -> int:
+        """
+        Replace the old subtree classes in markup files with renamed ones.
+
+        Call it after the object is renamed
+        Args:
+            old_css_name: Css name of the object before renaming
+            old_names: get_css_names() before renaming
+        """
+        mapping = {x: self.cssName + x[len(old_css_name):] for x in old_names}
+        return self.BEM.rewrite_markup(mapping)
+
+    def set_css(self, new_css: str) -> bool:
         """
-        Update css file
+        Update css file. Nothing is written if the content is the same
         Args:
             new_css: Raw string that will be written in the cssFile
+        Returns false if the write was skipped
         """
         if self.cssFile.exists():
-            self.cssFile.write_text(new_css, "utf-8")   # Write new css
+            return self.BEM.write_css(self.cssFile, new_css)   # Write new css
         else:
             self.error(FileNotFoundError(f"Can't find {self.cssFile}"))
+            return False
 
     def _rename(self, new_name: str):
         """
@@ -753,9 +2859,9 @@ class _BEMGen:
             self._remove(True)
             # Update object variables
             self.update_name(new_name)
-            # Create new object
+            # Create new object with the changed css
+            self.css = css
             self._create()
-            self.set_css(css)
 
 
 class Block(_BEMGen):
@@ -777,6 +2883,8 @@ class Block(_BEMGen):
         """
         Find block elements.
         """
+        if self.BEM.layout == "flat":
+            return self._flat_elements(self._flat_suffixes(self.cssName + "__"))
         elements = []
 
         for x in self.path.glob("__*"):
@@ -784,15 +2892,45 @@ class Block(_BEMGen):
             elements[-1].modifiers = elements[-1].get_descendant_modifiers()
         return elements
 
+    def _flat_elements(self, suffixes: list[str]) -> list:
+        """
+        Make elements with modifiers from flat file names like "title" or "title_size_s"
+        """
+        groups = dict()
+        for x in suffixes:
+            name, _, rest = x.partition("_")
+            groups.setdefault(name, [])
+            if rest:
+                groups[name].append(rest)
+        elements = []
+        for name, rest in groups.items():
+            elements.append(Element(self.BEM, self, name))
+            elements[-1].modifiers = elements[-1]._flat_modifiers(rest)
+        return elements
+
     def parse_descendants(self):
         """
         Set block modifiers and block elements
 
-        Only the nearest
+        Only the nearest. Flat layout is parsed by a single folder scan
         """
+        if self.BEM.layout == "flat":
+            suffixes = self._flat_suffixes(self.cssName + "_")
+            self.modifiers = self._flat_modifiers(suffixes)
+            self.elements = self._flat_elements([x[1:] for x in suffixes if x.startswith("_")])
+            return
         self.modifiers = self.get_descendant_modifiers()
         self.elements = self.get_descendant_elements()
 
+    def to_dict(self) -> dict:
+        """
+        Add descendants to the snapshot entry
+        """
+        d = super().to_dict()
+        d["modifiers"] = [x.to_dict() for x in self.modifiers]
+        d["elements"] = [x.to_dict() for x in self.elements]
+        return d
+
     def update_name(self, new_name: str):
         """
         Set the rules of naming.
@@ -805,6 +2943,7 @@ class Block(_BEMGen):
         self.cssName = new_name
         super().update_name(new_name)
 
+    @_transactional
     def create(self):
         """
         Create block folder and css file.
@@ -820,6 +2959,8 @@ class Block(_BEMGen):
             x.ancestor = self
             x.create()
 
+    @_confirmed
+    @_transactional
     def remove(self, force: bool = False):
         """
         Remove the block with elements and modifiers.
@@ -837,14 +2978,95 @@ class Block(_BEMGen):
                 x.remove(True)
             return super()._remove(True)
 
-    def rename(self, new_name: str):
+    def get_css_names(self) -> list[str]:
+        """
+        Return css names of the block, its elements and modifiers
+        """
+        names = super().get_css_names()
+        for x in self.modifiers + self.elements:
+            names.extend(x.get_css_names())
+        return names
+
+    def get_css_files(self) -> list[Path]:
+        """
+        Return css files of the block, its elements and modifiers
+        """
+        files = super().get_css_files()
+        for x in self.modifiers + self.elements:
+            files.extend(x.get_css_files())
+        return files
+
+    @_transactional
+    def rename(self, new_name: str, markup: bool = False):
         """
         Rename block, update naming and imports
+        Args:
+            new_name: New block name
+            markup: Replace the block classes in markup files too
         """
         if self._rename_check_existence(new_name):
-            self.remove(True)
-            self.update_name(new_name)
-            self.create()
+            self.parse_descendants()
+            old_css_name, old_names = self.cssName, self.get_css_names()
+            with self._renaming():
+                self.remove(True)
+                self.update_name(new_name)
+                self.create()
+            if markup:
+                self._rename_markup(old_css_name, old_names)
+
+    @_transactional
+    def clone(self, new_name: str) -> Self:
+        """
+        Copy the block with elements, modifiers and their css as a new block.
+
+        The folder is copied as a whole. Css files are renamed and their classes
+        are replaced line by line while they are copied. Import lines are added at once
+        Args:
+            new_name: New block name
+        Returns the new block
+        """
+        if not self.exists():
+            self.error(FileNotFoundError(f"Cannot clone! {self.name} doesn't exist!"))
+        block = Block(self.BEM, new_name)
+        if block.exists():
+            block.error(FileExistsError(f"Cannot clone! {new_name} already exists!"))
+
+        old_css_name = self.cssName
+        # Exact class selector. Block classes go on with "_" only
+        selector = re.compile(rf"\.{re.escape(old_css_name)}(?![a-zA-Z0-9-])")
+
+        def copy_file(src: str, dst: str) -> str:
+            name = os.path.basename(dst)
+            rest = name[len(old_css_name):]
+            # Object files only: "card.css" and "card_..." / "card__..." but not "cardboard.css"
+            if not (name.startswith(old_css_name) and name.endswith(".css") and rest[0] in "._"):
+                return shutil.copy2(src, dst)
+            dst = os.path.join(os.path.dirname(dst), block.cssName + rest)
+            with open(src, "r", encoding="utf-8") as f, open(dst, "w", encoding="utf-8") as out:
+                for line in f:
+                    out.write(selector.sub(f".{block.cssName}", line))
+            shutil.copymode(src, dst)
+            return dst
+
+        shutil.copytree(self.path, block.path, copy_function=copy_file)
+        block.parse_descendants()
+        for x in block.iter_tree():
+            for line in x.get_import_lines():
+                self.BEM.append_import(line)
+            for event in x.get_events("created"):
+                self.BEM._emit(event)
+            self.BEM._index_add(x)
+        return block
+
+    def iter_tree(self):
+        """
+        Yield the block, its modifiers, elements and element modifiers
+        """
+        yield self
+        yield from self.modifiers
+        for x in self.elements:
+            yield x
+            yield from x.modifiers
 
 
 class _BemGenBM(_BEMGen):
@@ -866,6 +3088,8 @@ class _BemGenBM(_BEMGen):
         Overrides the _BEMGen method.
         """
         self.path = self.ancestor.path / new_name        # Object location
+        if self.BEM.layout == "flat":
+            self.path = self.ancestor.path              # Block folder keeps everything
         self.cssName = self.ancestor.cssName + new_name  # CSS naming rules
         super().update_name(new_name)
 
@@ -910,6 +3134,15 @@ class Element(_BemGenBM):
         """
         self.modifiers = self.get_descendant_modifiers()
 
+    def to_dict(self) -> dict:
+        """
+        Add modifiers to the snapshot entry
+        """
+        d = super().to_dict()
+        d["modifiers"] = [x.to_dict() for x in self.modifiers]
+        return d
+
+    @_transactional
     def create(self):
         """
         Create element folder and css file
@@ -919,6 +3152,8 @@ class Element(_BemGenBM):
             x.ancestor = self
             x.create()
 
+    @_confirmed
+    @_transactional
     def remove(self, force: bool = False):
         """
         Remove the element with modifiers
@@ -929,23 +3164,49 @@ class Element(_BemGenBM):
                 x.remove(True)
             return super()._remove(True)
 
-    def rename(self, new_name: str):
+    def get_css_names(self) -> list[str]:
+        """
+        Return css names of the element and its modifiers
+        """
+        names = super().get_css_names()
+        for x in self.modifiers:
+            names.extend(x.get_css_names())
+        return names
+
+    def get_css_files(self) -> list[Path]:
+        """
+        Return css files of the element and its modifiers
+        """
+        files = super().get_css_files()
+        for x in self.modifiers:
+            files.extend(x.get_css_files())
+        return files
+
+    @_transactional
+    def rename(self, new_name: str, markup: bool = False):
         """
         Rename element. Change imports.
+        Args:
+            new_name: New element name
+            markup: Replace the element classes in markup files too
         """
         new_name = "__" + new_name.lstrip("_")
         self.parse_descendants()
         if self._rename_check_existence(new_name):
+            old_css_name, old_css_names = self.cssName, self.get_css_names()
             old_names = []
             for i in range(len(self.modifiers)):
                 old_names.append(self.modifiers[i].cssName)
 
-            self.remove(True)
-            self.update_name(new_name)
-            self.create()
+            with self._renaming():
+                self.remove(True)
+                self.update_name(new_name)
+                self.create()
 
             for i in range(len(self.modifiers)):
                 self.modifiers[i].update_css(old_names[i])
+            if markup:
+                self._rename_markup(old_css_name, old_css_names)
 
 
 class Modifier(_BemGenBM):
@@ -962,10 +3223,12 @@ class Modifier(_BemGenBM):
         """
         name = "_" + name.lstrip("_")
 
+        self._value = None      # Value focused by _set_value
+
         # The modifier with values has got some own variables
         if values is not None:
             self.values = values
-            self.values_css = {x: "" for x in self.values}
+            self.values_css = {x: None for x in self.values}
         else:
             self.values = []
             self.values_css = dict()
@@ -981,20 +3244,123 @@ class Modifier(_BemGenBM):
         self.cssName = self.ancestor.cssName + self.name + "_" + value
         self.cssFile = self.path / f"{self.cssName}.css"
         self.css = self.values_css.get(value)
+        self._value = value
+
+    def update_name(self, new_name: str):
+        """
+        Update paths and names. Remove _set_value effect
+        """
+        self._value = None
+        super().update_name(new_name)
+
+    def get_template_vars(self) -> tuple[str, dict]:
+        """
+        Use value template if a value is focused
+        """
+        node_type, variables = super().get_template_vars()
+        if self._value is not None:
+            node_type = "value"
+            variables["value"] = self._value
+        return node_type, variables
+
+    def to_dict(self) -> dict:
+        """
+        Add values to the snapshot entry. Bool modifier has an empty list
+        """
+        d = super().to_dict()
+        d["values"] = list(self.values)
+        return d
+
+    def exists(self) -> bool:
+        """
+        Flat modifier exists if it has its own or value css files
+        """
+        if self.BEM.layout != "flat":
+            return super().exists()
+        name = self.ancestor.cssName + self.name
+        return self.path.joinpath(f"{name}.css").exists() or len(self._flat_suffixes(name + "_")) != 0
+
+    def get_css_entries(self) -> list[tuple]:
+        """
+        Return an entry of the bool modifier or entries of every value
+        """
+        if len(self.values) == 0:
+            return super().get_css_entries()
+        entries = []
+        for value in self.values:
+            self._set_value(value)
+            entries.append((value, self.cssFile, self.build_import_line()))
+        self.update_name(self.name)
+        return entries
 
     def parse_values(self):
         """
         Iterate over the directory(self.path).
         Set values if they exist
+
+        File names are compared with the css name, so a single value or values with "_" are found.
+        During BEM.parse() the folder is listed only if it was changed since the manifest was saved
         """
-        contents = list(self.path.iterdir())
-        # Do not support single key-value
-        if len(contents) != 1:
-            for x in contents:
-                value = str(x.stem)
-                value = value[value.rfind("_")+1:]
-                self.values.append(value)
+        if self.BEM.layout == "flat":
+            self.values.extend(self._flat_suffixes(self.ancestor.cssName + self.name + "_"))
+            return
+        if self.BEM._manifest is None:
+            self.values.extend(self._scan_values()["values"])
+            return
+
+        mtime = self.path.stat().st_mtime_ns
+        entry = self.BEM._manifest.get(self.cssName)
+        if entry is not None:
+            # Hashes save reading unchanged files later. See BEM._content_hash()
+            for name, (file_mtime, size, digest) in entry["files"].items():
+                self.BEM._hashes.setdefault(self.path / name, (file_mtime, size, bytes.fromhex(digest)))
+        if entry is not None and entry["mtime"] == mtime:
+            # Hashes found since the manifest was saved go to it
+            files = self._known_hashes(self.cssName + ".css", *(f"{self.cssName}_{x}.css" for x in entry["values"]))
+            if files != entry["files"]:
+                entry = dict(entry, files=files)
+        else:
+            entry = self._scan_values(True)
+            # Files could be added within the same mtime tick, so a fresh folder is listed again
+            entry["mtime"] = mtime if time.time_ns() - mtime > self.BEM.RACY_NS else None
+        self.BEM._manifest_new[self.cssName] = entry
+        self.values.extend(entry["values"])
 
+    def _scan_values(self, hashes: bool = False) -> dict:
+        """
+        List the modifier folder. Files are not read
+        Args:
+            hashes: Record the content hashes the controller already knows. See _known_hashes()
+        Returns manifest entry with "values" and "files" (name to mtime, size and hash)
+        """
+        values = []
+        names = []
+        with os.scandir(self.path) as it:
+            for x in it:
+                if not x.name.endswith(".css") or not x.is_file():
+                    continue
+                stem = x.name[:-4]
+                if stem.startswith(self.cssName + "_"):
+                    values.append(stem[len(self.cssName) + 1:])
+                elif stem != self.cssName:
+                    continue
+                names.append(x.name)
+        return {"values": sorted(values), "files": self._known_hashes(*names) if hashes else dict()}
+
+    def _known_hashes(self, *names: str) -> dict:
+        """
+        Return (mtime, size, hash) of the folder files hashed by the controller, e.g. by write_css().
+
+        The mtime and size are the ones of the hashed content, so a changed file is read again anyway
+        """
+        files = dict()
+        for name in sorted(names):
+            entry = self.BEM._hashes.get(self.path / name)
+            if entry is not None:
+                files[name] = [entry[0], entry[1], entry[2].hex()]
+        return files
+
+    @_transactional
     def create(self):
         """
         Create modifier folder and css file.
@@ -1010,21 +3376,96 @@ class Modifier(_BemGenBM):
                 self._create_resolve_css()  # Make css file
             self.update_name(self.name)     # Remove _set_value effect
 
+    @_transactional
+    def add_values(self, values: dict | list[str]):
+        """
+        Add value files and their import lines at once.
+
+        The modifier folder is created if needed
+        Args:
+            values: Value to css dict. None css or a list of values use the value template
+        """
+        if isinstance(values, list):
+            values = dict.fromkeys(values)
+        if len(self.values) == 0 and self.exists():
+            self.error(TypeError("Can't add values. Modifier is bool or its values are not parsed"))
+        for value in values:
+            self._set_value(value)
+            if value in self.values or self.cssFile.exists():
+                self.update_name(self.name)
+                self.error(FileExistsError(f"Value {value} already exists!"))
+        self.update_name(self.name)
+
+        if not self.exists():
+            super()._create(True)
+        lines = []
+        for value, css in values.items():
+            self._set_value(value)
+            css = self.get_default_content() if css is None else css
+            self.BEM.write_css(self.cssFile, css)
+            lines.append(self.build_import_line())
+            self.BEM._emit(self._event("created"))
+            self.values.append(value)
+            self.values_css[value] = css
+        self.update_name(self.name)
+        self.BEM.append_import("".join(lines))
+
+    def _remove_values(self, values: list[str]):
+        """
+        Delete value files and their import lines at once. Keep values and their css.
+
+        Every value is checked before anything is deleted
+        """
+        for value in values:
+            self._set_value(value)
+            if not self.cssFile.exists():
+                self.update_name(self.name)
+                self.error(FileNotFoundError(f"Value {value} doesn't exist!"))
+
+        lines = dict()
+        for value in values:
+            self._set_value(value)      # Change css to focus on value
+            self.values_css[value] = self.get_css()     # Save css
+            self.BEM._snapshot(self.cssFile)
+            self.cssFile.unlink()
+            lines[self.build_import_line()] = ""
+            self.BEM._emit(self._event("removed"))
+        self.update_name(self.name)     # Remove _set_value effect
+        self.BEM.replace_imports(lines)
+
+        # Remove folder if it is empty
+        if self.BEM.layout != "flat" and self.path.exists() and not any(self.path.iterdir()):
+            self.path.rmdir()
+        if not self.exists():
+            self.BEM._index_remove(self)
+
+    @_confirmed
+    @_transactional
     def remove_values(self, values: list[str], force: bool = False):
         """
-        Remove only given values
+        Remove only given values. Import file is changed once
         Args:
             values: List of values
             force: Prompt for removal permission
+        Returns true if removed
         """
         if force or self._get_remove_permission():
-            for value in values:
-                self._set_value(value)  # Change css to focus on value
-                super()._remove(True)   # Remove, which updates self.css
-                self.values_css[value] = self.css   # Save css
+            values = list(values)
+            self._remove_values(values)
+            self.values = [x for x in self.values if x not in values]
+            return True
+        return False
 
-            self.update_name(self.name)  # Remove _set_value effect
+    def _confirm_remove(self, force: bool) -> bool:
+        """
+        Key-value modifier without parsed values is not asked about, its removal raises an error
+        """
+        if len(self.values) == 0 and not self.cssFile.exists():
+            return True
+        return super()._confirm_remove(force)
 
+    @_confirmed
+    @_transactional
     def remove(self, force: bool = False):
         """
         Delete modifier directory, css files and imports.
@@ -1039,8 +3480,11 @@ class Modifier(_BemGenBM):
                     "Can't remove. Modifier is key-value. Call parse_values() at first!"))
             else:
                 return super()._remove(force)
-        else:
-            self.remove_values(self.values, force)
+        elif force or self._get_remove_permission():
+            # Values are kept, so the modifier could be created again
+            self._remove_values(self.values)
+            return True
+        return False
 
     def rename_value(self, value: str, new_value: str):
         """
@@ -1049,42 +3493,75 @@ class Modifier(_BemGenBM):
             value: The old value name
             new_value: The new value name
         """
-        # Rename css class
-        self._set_value(new_value)
-        new_css_name = self.cssName
-        self._set_value(value)
-        css = self.get_css().replace(self.cssName, new_css_name)  # Probably can corrupt css
-        # Focus on new css file
-        self._set_value(new_value)
-        if self.cssFile.exists():
-            self.error(FileExistsError(
-                f"Cannot update value from {value} to {new_value}"))
-        else:
-            # Make new css file
-            self._create_resolve_css()
-            self.set_css(css)
-            # Remove old one
+        self.rename_values({value: new_value})
+
+    @_transactional
+    def rename_values(self, mapping: dict):
+        """
+        Rename value files and css classes. Import lines are replaced in place at once
+        Args:
+            mapping: Old value to new value dict
+        """
+        if len(set(mapping.values())) != len(mapping):
+            self.error(ValueError("New values must be different"))
+        for value, new_value in mapping.items():
             self._set_value(value)
-            self.cssFile.unlink()
-        # Set modifier paths to default
+            if not self.cssFile.exists():
+                self.update_name(self.name)
+                self.error(FileNotFoundError(f"Value {value} doesn't exist!"))
+            self._set_value(new_value)
+            if self.cssFile.exists() and new_value not in mapping:
+                self.update_name(self.name)
+                self.error(FileExistsError(f"Cannot update value from {value} to {new_value}"))
+
+        # Contents are read before writing, so values could be swapped
+        contents = dict()
+        for value in mapping:
+            self._set_value(value)
+            contents[value] = (self._event("renamed"), self.get_css())
+            self.BEM._snapshot(self.cssFile)
+        targets = set()
+        lines = dict()
+        for value, new_value in mapping.items():
+            old, css = contents[value]
+            self._set_value(new_value)
+            targets.add(self.cssFile)
+            # Exact class selector
+            css = re.sub(rf"\.{re.escape(old['cssName'])}(?![\w-])", f".{self.cssName}", css)
+            self.BEM.write_css(self.cssFile, css)
+            line = self.build_import_line()
+            lines[old["imports"][0]] = line
+            self.BEM._emit(self._renamed_event(old, old["imports"], [line]))
+            self.values_css[new_value] = css
+        for value, (old, _) in contents.items():
+            if old["path"] not in targets:
+                old["path"].unlink()
+            if value not in mapping.values():
+                self.values_css.pop(value, None)
         self.update_name(self.name)
+        self.values = [mapping.get(x, x) for x in self.values]
+        self.BEM.replace_imports(lines)
 
-    def update_css(self, old_name: str):
+    def update_css(self, old_name: str) -> int:
         """
         Update css file (or files if it's a value type)
         Args:
             old_name:  Old css name to be replaced
+        Returns the number of skipped unchanged writes
         """
+        skipped = 0
+        new_name = self.cssName
         if len(self.values) == 0:
-            self.css = self.get_css().replace(old_name, self.cssName)
-            self.set_css(self.css)
+            self.css = self.get_css().replace(old_name, new_name)
+            skipped += not self.set_css(self.css)
         else:
             for x in self.values:
                 self._set_value(x)
                 self.values_css[x] = self.get_css().replace(
-                    old_name, self.cssName)
-                self.set_css(self.values_css[x])
+                    old_name, new_name)
+                skipped += not self.set_css(self.values_css[x])
             self.update_name(self.name)
+        return skipped
 
     def get_css_with_values(self) -> dict:
         """
@@ -1097,14 +3574,19 @@ class Modifier(_BemGenBM):
         self.update_name(self.name)
         return d
 
-    def set_css_with_values(self):
+    def set_css_with_values(self) -> int:
         """
-        Write self.values_css matter to their files
+        Write self.values_css matter to their files. Values without css (None) are skipped
+        Returns the number of skipped unchanged writes
         """
+        skipped = 0
         for x in self.values:
+            if self.values_css.get(x) is None:
+                continue
             self._set_value(x)
-            self.set_css(self.values_css[x])
+            skipped += not self.set_css(self.values_css[x])
         self.update_name(self.name)
+        return skipped
 
     def _rename_with_values(self, new_name: str):
         """
@@ -1122,31 +3604,80 @@ class Modifier(_BemGenBM):
                 self._set_value(value)
                 # Update css with a new name
                 css = self._rename_change_css(new_name, self.get_css())
-                # Make new css value file
+                # Make new css value file with updated css
                 self.update_name(new_name)
                 self._set_value(value)
+                self.css = css
                 self._create_resolve_css()
-                # Write updated css in new file
-                self.set_css(css)
             # Remove old files
             self.update_name(old_name)
             self.remove(True)
             # Update variables with a new name
             self.update_name(new_name)
 
-    def rename(self, new_name: str):
+    def get_css_names(self) -> list[str]:
+        """
+        Return css name of the bool modifier or names of every value
+        """
+        if len(self.values) == 0:
+            return super().get_css_names()
+        return [f"{self.cssName}_{x}" for x in self.values]
+
+    def get_css_files(self) -> list[Path]:
+        """
+        Return css file of the bool modifier or files of every value
+        """
+        if len(self.values) == 0:
+            return super().get_css_files()
+        return [self.path / f"{x}.css" for x in self.get_css_names()]
+
+    @_transactional
+    def rename(self, new_name: str, markup: bool = False):
         """
         Rename modifier files. Change imports.
+        Args:
+            new_name: New modifier name
+            markup: Replace the modifier classes in markup files too
         """
         new_name = "_" + new_name.lstrip("_")
-        if len(self.values) == 0:
-            if not self.cssFile.exists():
-                self.error(TypeError(
-                    "Can't rename. Modifier is key-value. Call parse_values() at first!"))
+        old_css_name, old_names = self.cssName, self.get_css_names()
+        with self._renaming():
+            if len(self.values) == 0:
+                if not self.cssFile.exists():
+                    self.error(TypeError(
+                        "Can't rename. Modifier is key-value. Call parse_values() at first!"))
+                else:
+                    super()._rename(new_name)
             else:
-                super()._rename(new_name)
-        else:
-            self._rename_with_values(new_name)
+                self._rename_with_values(new_name)
+        if markup:
+            self._rename_markup(old_css_name, old_names)
+
+    def get_import_lines(self) -> list[str]:
+        """
+        Return import line of the bool modifier or lines of every value
+        """
+        if len(self.values) == 0:
+            return super().get_import_lines()
+        lines = []
+        for value in self.values:
+            self._set_value(value)
+            lines.append(self.build_import_line())
+        self.update_name(self.name)
+        return lines
+
+    def get_events(self, event: str) -> list[dict]:
+        """
+        Describe the bool modifier file or files of every value
+        """
+        if len(self.values) == 0:
+            return super().get_events(event)
+        events = []
+        for value in self.values:
+            self._set_value(value)
+            events.append(self._event(event))
+        self.update_name(self.name)
+        return events
 
     def update_import_line(self) -> int:
         c = 0
@@ -1161,7 +3692,551 @@ class Modifier(_BemGenBM):
         return c
 
 
-# Launch console as a default
+class BEMWorkspace:
+    """
+    Controller of several BEM projects sharing one worker pool
+    """
+    # Workspace config file in the root folder
+    CONFIG = "bem-workspace.json"
+
+    def __init__(self, root: Path, projects: list[dict] | None = None, workers: int | None = None):
+        """
+        Find projects and parse them concurrently
+
+        Args:
+            root: Workspace folder path
+            projects: List of {"root", "blocks", "css"} paths. Project root is related to the workspace root,
+                blocks and css are related to the project root. Read from CONFIG or found by default
+            workers: Number of worker threads
+        """
+        if not root.exists():
+            raise FileNotFoundError("Can't find workspace folder")
+        self.rootDir = root
+        self.executor = ThreadPoolExecutor(workers)
+
+        if projects is None:
+            projects = self.read_config()
+        if projects is None:
+            projects = self.find_projects()
+
+        self.projects = []      # BEM instances
+        for x in projects:
+            project_root = root / x["root"]
+            self.projects.append(BEM(project_root,
+                                     project_root / x.get("blocks", "src/blocks"),
+                                     project_root / x.get("css", "src/index.css"),
+                                     autoparse=False))
+        self.parse()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker threads
+        """
+        self.executor.shutdown()
+
+    def read_config(self) -> list[dict] | None:
+        """
+        Return projects from CONFIG file or None if there is no config
+        """
+        config = self.rootDir / self.CONFIG
+        if not config.exists():
+            return None
+        return json.loads(config.read_text("utf-8"))["projects"]
+
+    def find_projects(self) -> list[dict]:
+        """
+        Find the projects laid out like src/index.css and src/blocks.
+
+        Hidden folders and node_modules are skipped
+        """
+        projects = []
+        for path, dirs, files in os.walk(self.rootDir):
+            dirs[:] = sorted(x for x in dirs if x != "node_modules" and not x.startswith("."))
+            path = Path(path)
+            if "index.css" in files and "blocks" in dirs and path != self.rootDir:
+                projects.append({"root": path.parent.relative_to(self.rootDir).as_posix(),
+                                 "blocks": f"{path.name}/blocks",
+                                 "css": f"{path.name}/index.css"})
+                dirs.clear()
+        return projects
+
+    def map(self, func) -> dict:
+        """
+        Call func with every project concurrently
+        Returns dict where key is project root and value is func result
+        """
+        return dict(zip([x.rootDir for x in self.projects], self.executor.map(func, self.projects)))
+
+    def parse(self) -> dict:
+        """
+        Parse all projects
+        """
+        return self.map(lambda bem: bem.parse())
+
+    def fix_imports(self) -> dict:
+        """
+        Add all missing imports in every project
+        Returns dict of updated lines counts
+        """
+        return self.map(lambda bem: bem.fix_imports())
+
+    def lint(self) -> dict:
+        """
+        Return missing import lines of every project
+        """
+        return self.map(lambda bem: bem.lint())
+
+    def show(self, objs_type: str = "all"):
+        """
+        Print the requested type of every project
+        """
+        for x in self.projects:
+            print(f"[{x.rootDir.relative_to(self.rootDir).as_posix()}]")
+            x.show(objs_type)
+
+
+class ImportGraph:
+    """
+    Graph of css files connected by @import statements
+    """
+    def __init__(self, root: Path):
+        """
+        Parse root file and everything it imports
+        Args:
+            root: Css import file
+        """
+        self.root = root.resolve()
+        self.imports = dict()       # File to the list of files it imports in order
+        self.importers = dict()     # File to the set of files that import it
+        self.missing = set()        # Imported files that don't exist
+        self.conditions = dict()    # (importer, file) to the at-rules of a conditional import, e.g. ["@media print"]
+        self.tops = {self.root}     # Files the graph is kept for: root and the files added by update()
+        self.update(self.root)
+
+    @staticmethod
+    def parse_imports(file: Path) -> list[Path]:
+        """
+        Return local files imported by file. Urls are skipped
+        """
+        return [x for x, _ in ImportGraph._parse(file)]
+
+    @staticmethod
+    def _parse(file: Path) -> list[tuple[Path, list[str]]]:
+        """
+        Return local files imported by file with the at-rules of their import conditions
+        """
+        files = []
+        for m in BEM.IMPORT_RE.finditer(file.read_text("utf-8")):
+            x = m.group(1)
+            if "://" not in x and not x.startswith("//"):
+                tail = m.string[m.end(1):m.end()]
+                files.append(((file.parent / x).resolve(), ImportGraph.at_rules(tail)))
+        return files
+
+    @staticmethod
+    def at_rules(tail: str) -> list[str]:
+        """
+        Return the at-rules that keep the import conditions of the inlined file.
+        E.g. ' layer(base) supports(display: grid) print;' gives
+        ["@layer base", "@supports (display: grid)", "@media print"]
+        Args:
+            tail: Import statement after the file path
+        """
+        m = re.match(r"""["']?\s*\)?\s*(?P<layer>layer(?:\((?P<name>[^)]*)\))?)?\s*"""
+                     r"""(?:supports\((?P<supports>(?:[^()]|\([^()]*\))*)\))?\s*(?P<media>[^;]*?)\s*;?\s*$""", tail)
+        if m is None:
+            return []
+        rules = []
+        if m.group("layer"):
+            rules.append(f"@layer {m.group('name').strip()}" if m.group("name") else "@layer")
+        if m.group("supports"):
+            rules.append(f"@supports ({m.group('supports').strip()})")
+        if m.group("media"):
+            rules.append(f"@media {m.group('media')}")
+        return rules
+
+    def update(self, file: Path) -> set[Path]:
+        """
+        Parse file imports again. Newly imported files are parsed too, files nothing reaches anymore are dropped.
+
+        A file that is not in the graph is kept with its imports, e.g. a css file not imported by the root
+        Returns files affected by the change. See affected()
+        """
+        file = file.resolve()
+        if file not in self.imports:
+            self.tops.add(file)
+        for x in set(self.imports.get(file, [])):
+            self.importers[x].discard(file)
+
+        stack = [file]
+        while stack:
+            x = stack.pop()
+            parsed = []
+            if x.exists():
+                self.missing.discard(x)
+                parsed = self._parse(x)
+            else:
+                self.missing.add(x)
+            self.imports[x] = [child for child, _ in parsed]
+            for child, rules in parsed:
+                if rules:
+                    self.conditions[(x, child)] = rules
+                else:
+                    self.conditions.pop((x, child), None)
+            for child in self.imports[x]:
+                self.importers.setdefault(child, set()).add(x)
+                if child not in self.imports:
+                    stack.append(child)
+        self.importers.setdefault(file, set())
+        self._drop_unreachable()
+        return self.affected(file)
+
+    def _drop_unreachable(self):
+        """
+        Forget the files that no top file imports directly or not
+        """
+        reachable = self.closure(self.tops)
+        for x in [x for x in self.imports if x not in reachable]:
+            for child in self.imports.pop(x):
+                self.importers.get(child, set()).discard(x)
+                self.conditions.pop((x, child), None)
+            self.importers.pop(x, None)
+            self.missing.discard(x)
+
+    def affected(self, file: Path) -> set[Path]:
+        """
+        Return file and every file that imports it directly or not
+        """
+        file = file.resolve()
+        result = {file}
+        stack = [file]
+        while stack:
+            for x in self.importers.get(stack.pop(), ()):
+                if x not in result:
+                    result.add(x)
+                    stack.append(x)
+        return result
+
+    def closure(self, files) -> set[Path]:
+        """
+        Return files and every file they import directly or not
+        """
+        result = set()
+        stack = [x.resolve() for x in files]
+        while stack:
+            x = stack.pop()
+            if x not in result:
+                result.add(x)
+                stack.extend(self.imports.get(x, ()))
+        return result
+
+    def order(self) -> list[Path]:
+        """
+        Return files in cascade order: imported files go before their importers.
+
+        Every file is listed once, cycles are cut
+        """
+        result = []
+        visited = set()
+        stack = [(self.root, iter(self.imports.get(self.root, [])))]
+        visited.add(self.root)
+        while stack:
+            file, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                result.append(file)
+            elif child not in visited:
+                visited.add(child)
+                stack.append((child, iter(self.imports.get(child, []))))
+        return result
+
+    def wrappers(self) -> dict[Path, list[str]]:
+        """
+        Return the at-rules to wrap the inlined content of conditionally imported files in.
+
+        Conditions of the imports on the path order() takes to the file are nested,
+        e.g. a file imported for print by a file imported for screen gets ["@media screen", "@media print"]
+        """
+        result = {self.root: []}
+        stack = [(self.root, iter(self.imports.get(self.root, [])))]
+        while stack:
+            file, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+            elif child not in result:
+                result[child] = result[file] + self.conditions.get((file, child), [])
+                stack.append((child, iter(self.imports.get(child, []))))
+        return {k: v for k, v in result.items() if v}
+
+    def cycles(self) -> list[list[Path]]:
+        """
+        Return import cycles reachable from the root
+        """
+        cycles = []
+        state = {self.root: 1}      # 1 is on the stack, 2 is done
+        stack = [(self.root, iter(self.imports.get(self.root, [])))]
+        while stack:
+            file, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                state[file] = 2
+            elif state.get(child) == 1:
+                path = [x for x, _ in stack]
+                cycles.append(path[path.index(child):] + [child])
+            elif child not in state:
+                state[child] = 1
+                stack.append((child, iter(self.imports.get(child, []))))
+        return cycles
+
+    def duplicates(self) -> dict[Path, list[Path]]:
+        """
+        Return files imported more than once with the list of their importers
+        """
+        count = dict()
+        for file, children in self.imports.items():
+            for x in children:
+                count.setdefault(x, []).append(file)
+        return {k: v for k, v in count.items() if len(v) > 1}
+
+
+class _RPCHandler(socketserver.StreamRequestHandler):
+    """
+    Answer line-delimited JSON-RPC 2.0 requests of one connection
+    """
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(json.dumps(self.server.dispatch(line)).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+
+class BEMServer(socketserver.UnixStreamServer):
+    """
+    Keep a parsed controller warm and serve it over a Unix socket.
+
+    Requests are handled one by one, so the model is never changed concurrently.
+    Methods are create / remove / rename / clone / show / fix / query / parse.
+    Create, remove and rename take the one line command words, e.g. ["m", "card", "__title", "size", "s"]
+    """
+    # Socket file name in the controller cache folder
+    SOCKET = "bem.sock"
+
+    # JSON-RPC error codes
+    PARSE_ERROR = -32700
+    METHOD_NOT_FOUND = -32601
+    INVALID_PARAMS = -32602
+    INTERNAL_ERROR = -32603
+    OPERATION_ERROR = -32000
+
+    @classmethod
+    def socket_path(cls, root: Path) -> Path:
+        """
+        Return the socket path of the project
+        """
+        return root / BEM.CACHE_DIR / cls.SOCKET
+
+    @classmethod
+    def call(cls, path: Path, method: str, params: list | dict | None = None, timeout: float = 30):
+        """
+        Send one request to a running server and return its result. See bem_client.call()
+
+        The client lives beside in bem_client.py. It is imported here, so BEM.py works alone
+        """
+        import bem_client
+        return bem_client.call(path, method, params, timeout)
+
+    def __init__(self, bem: BEM, path: Path | None = None):
+        """
+        Bind the socket. Call serve_forever() to start answering
+        Args:
+            bem: Parsed controller
+            path: Socket path. Project cache folder is default
+        """
+        self.bem = bem
+        self._seen = self._state()
+        self.path = path or self.socket_path(bem.rootDir)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            # Socket left by a killed server is replaced, a live one is not
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(str(self.path))
+                raise FileExistsError(f"Server is already running on {self.path}")
+            except ConnectionRefusedError:
+                self.path.unlink()
+        super().__init__(str(self.path), _RPCHandler)
+
+    def server_close(self):
+        """
+        Close and delete the socket
+        """
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+    def dispatch(self, line: bytes) -> dict:
+        """
+        Perform one JSON-RPC request and return the response
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return self._error(None, self.PARSE_ERROR, f"Parse error: {e}")
+        if not isinstance(request, dict):
+            return self._error(None, self.PARSE_ERROR, "Request must be an object")
+        rid = request.get("id")
+        func = getattr(self, f"rpc_{request.get('method')}", None)
+        if func is None:
+            return self._error(rid, self.METHOD_NOT_FOUND, f"Unknown method: {request.get('method')}")
+
+        params = request.get("params", [])
+        try:
+            bound = inspect.signature(func).bind(**params) if isinstance(params, dict) else \
+                inspect.signature(func).bind(*params)
+        except TypeError as e:
+            return self._error(rid, self.INVALID_PARAMS, str(e))
+        try:
+            with self.bem.lock(exclusive=False):
+                if self._state() != self._seen:
+                    # Another controller changed the project since the last request
+                    self.bem.parse()
+            # Hooks of the operation run after its lock is released, so it is not held here
+            result = func(*bound.args, **bound.kwargs)
+            self._seen = self._state()
+        except FileExistsError:
+            return self._error(rid, self.OPERATION_ERROR, "Already exists!")
+        except FileNotFoundError:
+            return self._error(rid, self.OPERATION_ERROR, "Not exist!")
+        except ValueError as e:
+            return self._error(rid, self.OPERATION_ERROR, str(e))
+        except Exception as e:
+            # The client gets an answer for any failure
+            return self._error(rid, self.INTERNAL_ERROR, f"Internal error: {type(e).__name__}: {e}")
+        return {"jsonrpc": "2.0", "id": rid, "result": result}
+
+    def _state(self) -> tuple:
+        """
+        Return the stamp of the import file and the blocks folder.
+        Every create / remove / rename of any controller changes it
+        """
+        stamp = []
+        for path in (self.bem.cssFile, self.bem.blocksDir):
+            try:
+                stat = path.stat()
+                stamp += [stat.st_mtime_ns, stat.st_size]
+            except FileNotFoundError:
+                stamp += [None, None]
+        return tuple(stamp)
+
+    @staticmethod
+    def _error(rid, code: int, message: str) -> dict:
+        """
+        Make JSON-RPC error response
+        """
+        return {"jsonrpc": "2.0", "id": rid, "error": {"code": code, "message": message}}
+
+    def _command(self, mode: str, args: tuple) -> tuple:
+        """
+        Resolve one line command words of create / remove / rename
+        """
+        parsed = self.bem._parse_command(mode, [str(x) for x in args]) if args else None
+        if parsed is None:
+            raise ValueError(f"Usage: {mode} <type> <block> [__element] [modifier] [values | new name]")
+        return parsed
+
+    def rpc_create(self, *args) -> dict:
+        """
+        Create object. Returns its snapshot entry
+        """
+        data, _ = self._command("create", args)
+        return self.bem.create(*data).to_dict()
+
+    def rpc_remove(self, *args) -> bool:
+        """
+        Remove object without confirmation
+        """
+        data, _ = self._command("remove", args)
+        return self.bem.remove(*data, force=True)
+
+    def rpc_rename(self, *args) -> dict:
+        """
+        Rename object. The last word is the new name. Returns its snapshot entry
+        """
+        data, new_name = self._command("rename", args)
+        return self.bem.rename(new_name, *data).to_dict()
+
+    def rpc_clone(self, block_name: str, new_name: str) -> dict:
+        """
+        Copy the block as a new one. Returns its snapshot entry
+        """
+        return self.bem.clone(block_name, new_name).to_dict()
+
+    def rpc_show(self, objs_type: str = "all") -> dict:
+        """
+        Return css names by type
+        """
+        result = {
+            "block": [x.cssName for x in self.bem.iter_blocks()],
+            "element": [x.cssName for x in self.bem.iter_elements()],
+            "modifier": [x.cssName for x in self.bem.iter_modifiers()]
+        }
+        if objs_type in ("", "all"):
+            return result
+        if objs_type not in result:
+            raise ValueError(f"Unknown type: {objs_type}")
+        return {objs_type: result[objs_type]}
+
+    def rpc_fix(self) -> int:
+        """
+        Add missing imports. Returns the number of updated lines
+        """
+        return self.bem.fix_imports()
+
+    def rpc_query(self, css_name: str) -> dict | None:
+        """
+        Return the object that owns the css class or None
+        """
+        obj, value = self.bem._css_names().get(css_name, (None, None))
+        if obj is None:
+            return None
+        return {"type": obj.type, "value": value, "object": obj.to_dict()}
+
+    def rpc_parse(self) -> int:
+        """
+        Scan the blocks folder again after changes made without the server.
+        Returns the number of blocks
+        """
+        self.bem.parse()
+        return len(self.bem.blocks)
+
+
+# Console is launched by default.
+# "BEM.py serve" keeps the parsed project in a server, "BEM.py call <method> [params...]" sends it a request
 if __name__ == "__main__":
-    bem = BEM.get_default_bem()
-    bem.start_loop()
+    if len(sys.argv) > 2 and sys.argv[1] == "call":
+        path = BEMServer.socket_path(Path(__file__).parent.parent)
+        try:
+            print(json.dumps(BEMServer.call(path, sys.argv[2], sys.argv[3:]), indent=2))
+        except (OSError, ImportError, ValueError, RuntimeError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    elif len(sys.argv) > 1 and sys.argv[1] == "serve":
+        # Stop on kill as on Ctrl+C, so the socket is deleted
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with BEMServer(BEM.get_default_bem()) as server:
+            print(f"Serving on {server.path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    else:
+        bem = BEM.get_default_bem()
+        bem.start_loop()
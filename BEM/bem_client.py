@@ -0,0 +1,53 @@
+import sys
+import json
+import socket
+from pathlib import Path
+
+
+# Socket of "BEM.py serve" in the project cache folder. Same as BEM.CACHE_DIR / BEMServer.SOCKET
+SOCKET = Path(".bem-cache") / "bem.sock"
+
+
+def socket_path(root: Path) -> Path:
+    """
+    Return the socket path of the project
+    """
+    return root / SOCKET
+
+
+def call(path: Path, method: str, params: list | dict | None = None, timeout: float = 30):
+    """
+    Send one request to a running server and return its result
+    Args:
+        path: Socket path. See socket_path()
+        method: Server method name
+        params: Positional or named method arguments
+        timeout: Seconds to wait for the answer
+    Raises RuntimeError with the server error message or when the server closed without an answer
+    """
+    request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or []}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise RuntimeError("Server closed the connection without an answer")
+    response = json.loads(line)
+    if "error" in response:
+        raise RuntimeError(response["error"]["message"])
+    return response["result"]
+
+
+# Thin client of the BEM.py server. It doesn't import the controller, so it starts fast:
+# "bem_client.py <method> [params...]"
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: bem_client.py <method> [params...]", file=sys.stderr)
+        sys.exit(2)
+    try:
+        print(json.dumps(call(socket_path(Path(__file__).parent.parent), sys.argv[1], sys.argv[2:]), indent=2))
+    except (OSError, ValueError, RuntimeError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -1,75 +1,1408 @@
 from BEM import *
 import unittest
+import sys
+import tempfile
 import time
+import tracemalloc
+import multiprocessing
+import threading
+import io
+import contextlib
+from unittest import mock
+import bem_client
 
-class Tests(unittest.TestCase):
 
-    def test_remove_modifier(self):
+def make_project(tmp: str) -> BEM:
+    """
+    Make an empty project in tmp folder and return its controller
+    """
+    root = Path(tmp)
+    root.joinpath("src", "blocks").mkdir(parents=True)
+    root.joinpath("src", "index.css").write_text("")
+    return BEM(root, root / "src" / "blocks", root / "src" / "index.css")
+
+def create_blocks(root: str, names: list[str]):
+    """
+    Create blocks with a separate controller. Run by concurrent test processes
+    """
+    root = Path(root)
+    b = BEM(root, root / "src" / "blocks", root / "src" / "index.css", autoparse=False)
+    for name in names:
+        b.create("block", name)
+
+
+# Audit events of filesystem calls counted by count_fs()
+FS_EVENTS = frozenset({"open", "os.listdir", "os.scandir", "os.mkdir", "os.rename", "os.remove", "os.rmdir",
+                       "os.truncate", "shutil.copyfile", "shutil.copytree", "shutil.move", "shutil.rmtree"})
+_fs_state = threading.local()
+
+
+def _audit_fs(event: str, args: tuple):
+    """
+    Count filesystem audit events of paths under the counted root. See count_fs()
+    """
+    counts = getattr(_fs_state, "counts", None)
+    if counts is None or event not in FS_EVENTS or not args:
+        return
+    path = args[0]
+    if isinstance(path, (str, bytes, os.PathLike)) and os.fsdecode(path).startswith(_fs_state.root):
+        counts[event] = counts.get(event, 0) + 1
+
+
+sys.addaudithook(_audit_fs)
+
+
+@contextlib.contextmanager
+def count_fs(root: Path):
+    """
+    Count filesystem calls of this thread under root by audit event name
+    """
+    _fs_state.root = str(root) + os.sep
+    _fs_state.counts = counts = dict()
+    try:
+        yield counts
+    finally:
+        _fs_state.counts = None
+
+
+class ScaleTests:
+    """
+    Create, rename, remove, fix and parse every object type in a project of BLOCKS blocks
+
+    Every block has a bool modifier and an element with a valued modifier.
+    Filesystem calls of one object change must not grow with the project
+    """
+    BLOCKS = 0
+    # Upper bounds of counted filesystem calls. The first change also makes the backup store folders
+    CREATE_FS = 20
+    RENAME_FS = {"block": 80, "element": 60, "bool": 24, "values": 40}
+    REMOVE_FS = {"block": 60, "element": 44, "bool": 24, "values": 36}
+    # Whole project operations may also open index.css, the lock and the caches
+    PROJECT_FS = 20
+    PARSE_FS_PER_BLOCK = 6
+    MANIFEST_FS_PER_BLOCK = 3
+
+    @classmethod
+    def setUpClass(cls):
+        cls.template = tempfile.TemporaryDirectory()
+        b = make_project(cls.template.name)
+        with b.transaction():
+            for i in range(cls.BLOCKS):
+                block = b.create("block", f"b{i}")
+                b.create("modifier", "hidden", block)
+                element = b.create("element", "title", block)
+                b.create("modifier", "size", element, ["s", "m", "l"])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.template.cleanup()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name) / "project"
+        shutil.copytree(self.template.name, root, ignore=shutil.ignore_patterns(".bem-cache", ".bem-store"))
+        self.bem = BEM(root, root / "src" / "blocks", root / "src" / "index.css")
+        self.block = next(x for x in self.bem.blocks if x.name == "b0")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @contextlib.contextmanager
+    def assertFsCalls(self, bound: int):
         """
-        Make block, element and modifiers for element. Then remove modifier
+        Fail if the block makes more than bound filesystem calls in the project
         """
-        b = BEM.get_default_bem()
-        block = Block(b, "aboba1")
-        if block.path.exists():
-            shutil.rmtree(block.path)
+        with count_fs(self.bem.rootDir) as counts:
+            yield counts
+        self.assertLessEqual(sum(counts.values()), bound, counts)
+
+    def imports(self) -> list[str]:
+        return self.bem.IMPORT_RE.findall(self.bem.cssFile.read_text())
+
+    def assertConsistent(self):
+        self.assertEqual(self.bem.lint(), [])
+        self.assertEqual(len(self.bem.blocks), self.BLOCKS)
+
+    def test_block(self):
+        b = self.bem
+        with self.assertFsCalls(self.CREATE_FS):
+            block = b.create("block", "fresh")
+        self.assertTrue(block.cssFile.exists())
+        self.assertEqual(self.imports()[-1], "blocks/fresh/fresh.css")
+        self.assertTrue(b.remove("block", "fresh", force=True))
+
+        with self.assertFsCalls(self.RENAME_FS["block"]):
+            b.rename("renamed", "block", "b0")
+        self.assertFalse(b.blocksDir.joinpath("b0").exists())
+        self.assertTrue(b.blocksDir.joinpath("renamed", "__title", "_size", "renamed__title_size_l.css").exists())
+        self.assertIn("blocks/renamed/_hidden/renamed_hidden.css", self.imports())
+        self.assertFalse(any(x.startswith("blocks/b0/") for x in self.imports()))
+        self.assertConsistent()
+
+        with self.assertFsCalls(self.REMOVE_FS["block"]):
+            self.assertTrue(b.remove("block", "renamed", force=True))
+        self.assertFalse(b.blocksDir.joinpath("renamed").exists())
+        self.assertFalse(any(x.startswith("blocks/renamed/") for x in self.imports()))
+        b.create("block", "b0")
+        self.assertConsistent()
+
+    def test_element(self):
+        b = self.bem
+        with self.assertFsCalls(self.CREATE_FS):
+            element = b.create("element", "head", self.block)
+        self.assertTrue(element.cssFile.exists())
+        self.assertIn("blocks/b0/__head/b0__head.css", self.imports())
+        self.assertTrue(b.remove("element", "head", self.block, force=True))
+
+        with self.assertFsCalls(self.RENAME_FS["element"]):
+            b.rename("caption", "element", "title", self.block)
+        self.assertTrue(b.blocksDir.joinpath("b0", "__caption", "_size", "b0__caption_size_s.css").exists())
+        self.assertFalse(b.blocksDir.joinpath("b0", "__title").exists())
+        self.assertEqual(self.block.elements[0].name, "__caption")
+        self.assertConsistent()
+
+        with self.assertFsCalls(self.REMOVE_FS["element"]):
+            self.assertTrue(b.remove("element", "caption", self.block, force=True))
+        self.assertFalse(b.blocksDir.joinpath("b0", "__caption").exists())
+        self.assertFalse(any("__caption" in x for x in self.imports()))
+        self.assertConsistent()
+
+    def test_bool_modifier(self):
+        b = self.bem
+        with self.assertFsCalls(self.CREATE_FS):
+            modifier = b.create("modifier", "active", self.block)
+        self.assertTrue(modifier.cssFile.exists())
+        self.assertIn("blocks/b0/_active/b0_active.css", self.imports())
+        self.assertTrue(b.remove("modifier", "active", self.block, force=True))
+
+        with self.assertFsCalls(self.RENAME_FS["bool"]):
+            b.rename("shown", "modifier", "hidden", self.block)
+        self.assertIn("blocks/b0/_shown/b0_shown.css", self.imports())
+        self.assertNotIn("blocks/b0/_hidden/b0_hidden.css", self.imports())
+        self.assertConsistent()
+
+        with self.assertFsCalls(self.REMOVE_FS["bool"]):
+            self.assertTrue(b.remove("modifier", "shown", self.block, force=True))
+        self.assertEqual(self.block.modifiers, [])
+        self.assertFalse(b.blocksDir.joinpath("b0", "_shown").exists())
+        self.assertConsistent()
+
+    def test_valued_modifier(self):
+        b = self.bem
+        element = self.block.elements[0]
+        with self.assertFsCalls(self.CREATE_FS):
+            modifier = b.create("modifier", "tone", element, ["dark", "light"])
+        self.assertEqual(modifier.values, ["dark", "light"])
+        self.assertEqual(self.imports()[-2:], ["blocks/b0/__title/_tone/b0__title_tone_dark.css",
+                                               "blocks/b0/__title/_tone/b0__title_tone_light.css"])
+        self.assertTrue(b.remove("modifier", "tone", element, force=True))
 
-        with open(block.BEM.cssFile, "w") as f:
-            f.write("")
+        with self.assertFsCalls(self.RENAME_FS["values"]):
+            b.rename("width", "modifier", "size", element)
+        folder = b.blocksDir / "b0" / "__title" / "_width"
+        self.assertEqual(sorted(x.name for x in folder.iterdir()),
+                         ["b0__title_width_l.css", "b0__title_width_m.css", "b0__title_width_s.css"])
+        self.assertConsistent()
 
-        block.create()
-        el = Element(b, block, "hello2")
-        el.create()
-        mod1 = Modifier(b, el, "greet", ["Joe", "Alex", "Bar"])
-        mod1.create()
-        mod2 = Modifier(b, el, "nokey",)
-        mod2.create()
-        mod1.remove(True)
+        with self.assertFsCalls(self.REMOVE_FS["values"]):
+            self.assertTrue(b.remove("modifier", "width", element, force=True))
+        self.assertFalse(folder.exists())
+        self.assertFalse(any("_width" in x for x in self.imports()))
+        self.assertConsistent()
 
-    def test_create_block(self):
+    def test_parse(self):
+        b = self.bem
+        with self.assertFsCalls(self.PARSE_FS_PER_BLOCK * self.BLOCKS + self.PROJECT_FS):
+            b.parse()
+        self.assertEqual(sorted(x.name for x in b.blocks), sorted(f"b{i}" for i in range(self.BLOCKS)))
+        self.assertEqual([len(list(b.iter_elements())), len(list(b.iter_modifiers()))], [self.BLOCKS, 2 * self.BLOCKS])
+        self.assertTrue(all(x.values == ["l", "m", "s"] for x in b.iter_modifiers("element")))
+
+        # Folders changed long ago are read from the manifest
+        past = time.time_ns() - 10 * b.RACY_NS
+        for x in b.iter_modifiers():
+            os.utime(x.path, ns=(past, past))
+        b.parse()
+        with self.assertFsCalls(self.MANIFEST_FS_PER_BLOCK * self.BLOCKS + self.PROJECT_FS):
+            b.parse()
+        self.assertTrue(all(x.values == ["l", "m", "s"] for x in b.iter_modifiers("element")))
+
+    def test_fix(self):
+        b = self.bem
+        b.cssFile.write_text("")
+        with self.assertFsCalls(self.PARSE_FS_PER_BLOCK * self.BLOCKS + self.PROJECT_FS):
+            self.assertEqual(b.fix_imports(), 6 * self.BLOCKS)
+        self.assertConsistent()
+        with self.assertFsCalls(self.PARSE_FS_PER_BLOCK * self.BLOCKS + self.PROJECT_FS):
+            self.assertEqual(b.fix_imports(), 0)
+
+
+class SmallProjectTests(ScaleTests, unittest.TestCase):
+    BLOCKS = 3
+
+
+class MediumProjectTests(ScaleTests, unittest.TestCase):
+    BLOCKS = 30
+
+
+class LargeProjectTests(ScaleTests, unittest.TestCase):
+    BLOCKS = 300
+
+
+class TempProjectTests(unittest.TestCase):
+    """
+    Tests that work in a throwaway project
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bem = make_project(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_structure(self):
         """
-        Create complex block structure
+        Make a block with elements and modifiers, remove a valued modifier, rename and remove the block
         """
-        b = BEM.get_default_bem()
-        block = Block(b, "block1")
-        block.create()
-        mod = Modifier(b, block, "boolmod")
-        mod.create()
+        b = self.bem
+        block = b.create("block", "block1")
+        b.create("modifier", "boolmod", block)
         for i in range(3):
-            element = Element(b, block, f"el{i}")
-            element.create()
+            b.create("element", f"el{i}", block)
+        element = b.create("element", "el-with-mods", block)
+        b.create("modifier", "mods", element, [str(i) for i in range(5)])
+        b.create("modifier", "nokey", element)
+        self.assertEqual(len(b.IMPORT_RE.findall(b.cssFile.read_text())), 12)
+
+        b.remove("modifier", "mods", element, force=True)
+        self.assertEqual([x.name for x in element.modifiers], ["_nokey"])
+        self.assertFalse(element.path.joinpath("_mods").exists())
+        b.rename("block2", "block", "block1")
+        self.assertTrue(b.blocksDir.joinpath("block2", "__el-with-mods", "_nokey", "block2__el-with-mods_nokey.css").exists())
+        self.assertEqual(b.lint(), [])
+        b.remove("block", "block2", force=True)
+        self.assertEqual(b.blocks, [])
+        self.assertEqual(b.cssFile.read_text().strip(), "")
+
+    def test_snapshot(self):
+        """
+        Export model to json and load it back without parsing
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card, ["s", "m"])
+        b.parse()
+
+        snapshot = b.rootDir / "bem.json"
+        text = b.to_json(snapshot)
+        loaded = BEM.from_snapshot(b.rootDir, snapshot)
+        self.assertEqual(loaded.to_json(), text)
+        self.assertEqual(sorted(loaded.get_modifiers()[0][0].values), ["m", "s"])
+        self.assertEqual(loaded.get_elements()[0].cssName, "card__title")
+        # Warm started controller completes names too
+        self.assertEqual(loaded._names[("", "block")].complete("ca"), ["card"])
+        self.assertEqual(loaded._names[("card", "element")].complete(""), ["title"])
+
+    def test_usage(self):
+        """
+        Report classes that no markup file uses. Second run is served from cache
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card, ["s", "m"])
+        b.create("modifier", "hidden", card)
+        b.parse()
+        b.rootDir.joinpath("index.html").write_text(
+            '<div class="card card_size_s"><h2 class="card__title-text"></h2></div>')
+        # Names outside of class places are not usage
+        b.rootDir.joinpath("app.js").write_text('import card__title from "./card__title";\n// card_hidden\n')
+
+        b.PARALLEL_THRESHOLD = 1
+        for _ in range(2):
+            unused = b.usage()
+            self.assertEqual([x.cssName for x in unused["element"]], ["card__title"])
+            self.assertEqual([x.cssName for x in unused["modifier"]], ["card_hidden"])
+            self.assertEqual([(x.cssName, v) for x, v in unused["value"]], [("card_size", "m")])
+            self.assertEqual(unused["block"], [])
 
-        element = Element(b, block, "el-with-mods")
-        element.create()
-        mods = Modifier(b, element, "mods", [str(i) for i in range(5)])
-        mods.create()
+        # Skipped folders are not entered at all
+        for x in ("node_modules/lib", ".git"):
+            b.rootDir.joinpath(x).mkdir(parents=True)
+            b.rootDir.joinpath(x, "page.html").write_text('<p class="card_hidden"></p>')
+        with count_fs(b.rootDir / "node_modules") as counts:
+            files = b._markup_files()
+        self.assertEqual(counts, dict())
+        self.assertEqual(sorted(x.name for x in files), ["app.js", "index.html"])
+        self.assertEqual(b._markup_files(["*.html"]), [b.rootDir / "index.html"])
 
-        ent = Element(b, block, "el-mod")
-        ent.create()
-        mods = Modifier(b, ent, "modded")
-        mods.create()
+        # Deleted markup leaves the cache. Empty and non-utf-8 files are scanned
+        b.rootDir.joinpath("app.js").unlink()
+        b.rootDir.joinpath("empty.html").write_text("")
+        b.rootDir.joinpath("latin.html").write_bytes(b'<p class="caf\xe9 card_hidden">\xe9</p>')
+        unused = b.usage()
+        self.assertEqual(unused["modifier"], [])
+        cached = b._load_cache("usage")["files"]
+        self.assertEqual(sorted(Path(x).name for x in cached), ["empty.html", "index.html", "latin.html"])
 
-    def test_rename_block(self):
+    def test_rename_markup(self):
         """
-        Rename block1 to block2
+        Rename a block and rewrite its subtree classes in markup
         """
-        b = BEM.get_default_bem()
-        block = Block(b, "block1")
-        block.rename("block2")
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card, ["s", "m"])
+        page = b.rootDir.joinpath("index.html")
+        page.write_text('<div class="card card_size_s card-x"><h2 class="card__title"></h2></div>')
+        untouched = b.rootDir.joinpath("other.html")
+        untouched.write_text('<div class="cards"></div>')
+        mtime = untouched.stat().st_mtime_ns
 
-    def test_remove_block(self):
+        b.rename("tile", "block", "card", markup=True)
+        self.assertEqual(page.read_text(),
+                         '<div class="tile tile_size_s card-x"><h2 class="tile__title"></h2></div>')
+        self.assertEqual(untouched.stat().st_mtime_ns, mtime)
+        self.assertTrue(b.blocksDir.joinpath("tile", "_size", "tile_size_m.css").exists())
+
+        # Only class places are rewritten, code and text are kept
+        script = b.rootDir.joinpath("app.jsx")
+        script.write_text(
+            'import card from "./card";\n'
+            'const card_size_s = card;\n'
+            'el.classList.add("tile", card);\n'
+            'export default () => <p className={`tile tile_size_s ${on ? "tile__title" : ""}`}>tile</p>;\n')
+        vue = b.rootDir.joinpath("card.vue")
+        vue.write_text('<i :class="{ \'tile_size_s\': tile }" class="tile">tile</i>')
+        b.rename("card", "block", "tile", markup=True)
+        self.assertEqual(script.read_text(),
+            'import card from "./card";\n'
+            'const card_size_s = card;\n'
+            'el.classList.add("card", card);\n'
+            'export default () => <p className={`card card_size_s ${on ? "card__title" : ""}`}>tile</p>;\n')
+        self.assertEqual(vue.read_text(), '<i :class="{ \'card_size_s\': tile }" class="card">tile</i>')
+
+    def test_launch_editor_batch(self):
         """
-        Remove block2
+        Files created within one transaction are opened by a single editor launch
         """
-        b = BEM.get_default_bem()
-        block = Block(b, "block2")
-        block.remove(True)
+        b = self.bem
+        launches = []
+        b._launch = lambda editor, files: launches.append((editor, files))
+        b.editor = "subl -n"
+        b.autolaunch = True
+        with b.transaction():
+            b.create("block", "card")
+            b.create("modifier", "size", b.blocks[-1], ["s", "m"])
+            self.assertEqual(launches, [])
+        self.assertEqual(len(launches), 1)
+        editor, files = launches[0]
+        self.assertEqual(editor, "subl -n")
+        self.assertEqual([x.name for x in files], ["card.css", "card_size_s.css", "card_size_m.css"])
 
-if __name__ == "__main__":
-    # Nothing should appear
-    suite = unittest.TestSuite()
-    suite.addTest(Tests("test_create_block"))
-    suite.addTest(Tests("test_rename_block"))
-    suite.addTest(Tests("test_remove_block"))
+        # Out of a transaction the editor starts at once
+        b.autolaunch = False
+        b.launch_editor(b.blocks[-1], "code")
+        self.assertEqual(len(launches), 2)
+        self.assertEqual(launches[1][0], "code")
+        self.assertEqual(b._editor_queue, dict())
+
+    def test_completion(self):
+        """
+        Complete names in the scope of the parent. Keep tries updated without parsing
+        """
+        b = self.bem
+        b.create("block", "card")
+        b.create("block", "cart")
+        card = b.blocks[0]
+        b.create("element", "title", card)
+        b.create("element", "text", card)
+        b.create("modifier", "size", card, ["s", "m"])
+
+        def complete(text, scope):
+            b._completion_scope = scope
+            options = []
+            while (x := b._complete(text, len(options))) is not None:
+                options.append(x)
+            return options
+
+        self.assertEqual(complete("car", ("", "block")), ["card", "cart"])
+        self.assertEqual(complete("__t", ("card", "element")), ["text", "title"])
+        self.assertEqual(complete("", ("card", "modifier")), ["size"])
+        self.assertEqual(complete("", ("cart", "element")), [])
+
+        b.rename("caption", "element", "title", card)
+        b.remove("block", "cart", force=True)
+        b.remove("modifier", "size", card, ["s", "m"], force=True)
+        self.assertEqual(complete("car", ("", "block")), ["card"])
+        self.assertEqual(complete("", ("card", "element")), ["caption", "text"])
+        self.assertEqual(complete("", ("card", "modifier")), [])
+        self.assertEqual([x.name for x in card.elements], ["__text", "__caption"])
+
+    def test_one_line_commands_and_macro(self):
+        """
+        Record one line commands and replay them in another project
+        """
+        b = self.bem
+        macro = b.rootDir / "macro.txt"
+        b.command(f"record {macro}")
+        b.command("create b card")
+        b.command("create e card title")
+        b.command("create m card __title size s m l")
+        b.command("create m card hidden")
+        b.command("rename m card __title size scale")
+        b.command("remove m card hidden", force=True)
+        b.command("record")
+        self.assertEqual(macro.read_text().splitlines(), [
+            "create block card",
+            "create element card title",
+            "create modifier card __title size s m l",
+            "create modifier card hidden",
+            "rename modifier card __title size scale",
+            "remove modifier card hidden",
+        ])
+        expected = b.cssFile.read_text()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            other = make_project(tmp)
+            writes = []
+            set_imports = other._set_imports
+            other._set_imports = lambda text: (writes.append(other._transaction_depth), set_imports(text))
+            other.play(macro)
+            self.assertEqual(other.cssFile.read_text(), expected)
+            self.assertTrue(other.blocksDir.joinpath("card", "__title", "_scale", "card__title_scale_l.css").exists())
+            self.assertFalse(other.blocksDir.joinpath("card", "_hidden").exists())
+            self.assertNotIn(0, writes)
+
+    def test_templates(self):
+        """
+        Create css files from custom templates and recognize untouched ones by hash
+        """
+        b = self.bem
+        b.set_template("element", ".$block {\n\t&$name {\n\t}\n}\n")
+        b.set_template("value", "// $$size: $value\n.$cssName {\n}\n")
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card, ["s"])
+
+        title = card.elements[0]
+        self.assertEqual(title.get_css(), ".card {\n\t&__title {\n\t}\n}\n")
+        self.assertEqual(b.blocksDir.joinpath("card", "_size", "card_size_s.css").read_text(),
+                         "// $size: s\n.card_size_s {\n}\n")
+        self.assertEqual(hashlib.sha1(title.get_css().encode()).digest(), b.default_hash(title))
+        with self.assertRaises(ValueError):
+            b.set_template("page", "")
+
+    def test_large_import_file(self):
+        """
+        Find and remove import lines without loading the whole file
+        """
+        b = self.bem
+        with open(b.cssFile, "w") as f:
+            for i in range(40000):
+                f.write(f"/* filler{i} block */\n@import url(\"blocks/filler{i}/filler{i}.css\");\n")
+        line = Block(b, "card").build_import_line()
+        b.cssFile.write_text(line + b.cssFile.read_text())
+        size = b.cssFile.stat().st_size
+
+        tracemalloc.start()
+        self.assertTrue(b.has_import(line))
+        b.remove_import(line)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.assertLess(peak, size / 4)
+        self.assertFalse(b.has_import(line))
+        self.assertEqual(b.cssFile.stat().st_size, size - len(line))
+        with self.assertRaises(ValueError):
+            b.remove_import(line)
+
+        # Object operations change the file in their transaction without loading it
+        size = b.cssFile.stat().st_size
+        tracemalloc.start()
+        card = b.create("block", "card")
+        b.create("modifier", "size", card, ["s", "m"])
+        b.rename("tile", "block", "card")
+        b.remove("modifier", "size", b.blocks[0], force=True)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, size / 4)
+        self.assertEqual(b.cssFile.read_bytes()[size:], Block(b, "tile").build_import_line().encode())
+        b.remove("block", "tile", force=True)
+        self.assertEqual(b.cssFile.stat().st_size, size)
+
+        # Line breaks of the file are kept
+        b.cssFile.write_bytes(b.cssFile.read_bytes()[:1000].replace(b"\n", b"\r\n"))
+        b.create("block", "card")
+        self.assertTrue(b.has_import(line.replace("card", "card")))
+        b.remove("block", "card", force=True)
+        with b.transaction():
+            b.create("block", "card")
+            b.rename("tile", "block", "card")
+        text = b.cssFile.read_bytes()
+        self.assertEqual(text.count(b"\n"), text.count(b"\r\n"))
+        self.assertTrue(text.endswith(Block(b, "tile").build_import_line().replace("\n", "\r\n").encode()))
+
+    def test_write_avoidance(self):
+        """
+        Skip writes of unchanged css and notice external changes
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("modifier", "size", card, ["s", "m"])
+        mod = card.modifiers[0]
+        mtime = card.cssFile.stat().st_mtime_ns
+
+        self.assertFalse(card.set_css(card.get_default_content()))
+        self.assertEqual(card.cssFile.stat().st_mtime_ns, mtime)
+        mod.values_css = mod.get_css_with_values()
+        self.assertEqual(mod.set_css_with_values(), 2)
+
+        card.cssFile.write_text(".card { color: red; }\n")
+        self.assertTrue(card.set_css(card.get_default_content()))
+        self.assertEqual(card.get_css(), card.get_default_content())
+
+        with b.transaction():
+            line = mod.get_import_lines()[-1]
+            b.remove_import(line)
+            b.append_import(line)
+            self.assertFalse(card.set_css(card.get_default_content()))
+        self.assertEqual(b.skipped_writes, 2)
+
+    def test_build(self):
+        """
+        Build minified bundle. Only changed files are minified again
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card, ["s"])
+        card.set_css("/* Card */\n.card {\n\tcolor : red;\n\tmargin: 0 auto;\n}\n")
+
+        module = sys.modules["BEM"]
+        minify = module._minify_css
+        calls = []
+        module._minify_css = lambda css: calls.append(css) or minify(css)
+        try:
+            out = b.build()
+            self.assertEqual(out.read_text(), ".card{color:red;margin:0 auto}")
+            self.assertEqual(len(calls), 3)
+
+            card.elements[0].set_css(".card__title { font-size: 2em }")
+            b.build()
+            self.assertEqual(out.read_text(), ".card{color:red;margin:0 auto}.card__title{font-size:2em}")
+            self.assertEqual(len(calls), 4)
+        finally:
+            module._minify_css = minify
+        self.assertIn(".card {", b.build(minify=False).read_text())
+
+    def test_minify_strings(self):
+        """
+        Minifier keeps strings and urls as they are, comment marks inside of them included
+        """
+        minify = sys.modules["BEM"]._minify_css
+        self.assertEqual(minify('.a::before { content: "a  b" ; }'), '.a::before{content:"a  b"}')
+        self.assertEqual(minify('.a { background: url("a /* b */.png") }'), '.a{background:url("a /* b */.png")}')
+        self.assertEqual(minify(".a { background: url(a /* b */.png) }"), ".a{background:url(a /* b */.png)}")
+        self.assertEqual(minify("/* it's */ .a { font-family: 'A  B', serif }"), ".a{font-family:'A  B',serif}")
+        self.assertEqual(minify('.a { content: "{}" } .b {}'), '.a{content:"{}"}')
+
+    def test_emit_for(self):
+        """
+        Page css has only the classes its markup uses, in import order
+        """
+        b = self.bem
+        b.create("block", "card")
+        b.create("block", "menu")
+        card = b.blocks[0]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card.elements[0], ["s", "m"])
+        b.create("modifier", "hidden", card)
+        card.elements[0].set_css('@import url("title-font.css");\n.card__title { color: red }\n')
+        b.blocksDir.joinpath("card", "__title", "title-font.css").write_text(".font { font-size: 1em }\n")
+        page = b.rootDir / "landing.html"
+        page.write_text('<div class="card__title card__title_size_m"></div><p class="card"></p>')
+
+        out = b.emit_for([page])
+        self.assertEqual(out, b.rootDir / "src" / "landing.page.css")
+        self.assertEqual(b.IMPORT_RE.findall(out.read_text()), [
+            "blocks/card/card.css",
+            "blocks/card/__title/card__title.css",
+            "blocks/card/__title/_size/card__title_size_m.css"
+        ])
+        b.rootDir.joinpath("dist").mkdir()
+        other = b.emit_for([page], out=b.rootDir / "dist" / "landing.css")
+        self.assertEqual(b.IMPORT_RE.findall(other.read_text())[0], "../src/blocks/card/card.css")
+
+        bundle = b.emit_for([page], bundle=True, minify=True).read_text()
+        self.assertEqual(bundle, ".font{font-size:1em}.card__title{color:red}")
+
+        # No pages: the result needs a name, and an empty page uses nothing
+        with self.assertRaises(ValueError):
+            b.emit_for([])
+        self.assertEqual(b.emit_for([], out=b.rootDir / "dist" / "empty.css").read_text(), "")
+
+        # Classes of unchanged markup are taken from the cache
+        cache = b._load_cache("usage")
+        cache["files"][str(page)][2] = ["menu"]
+        b._save_cache("usage", cache)
+        self.assertEqual(b.IMPORT_RE.findall(b.emit_for([page]).read_text()), ["blocks/menu/menu.css"])
+
+    def test_import_graph(self):
+        """
+        Resolve nested imports, find cycles and duplicates, update a single file
+        """
+        b = self.bem
+        b.create("block", "card")
+        b.create("block", "menu")
+        card, menu = b.blocks
+        shared = b.rootDir.joinpath("src", "shared.css")
+        shared.write_text(".shared { color: red }\n")
+        card.set_css('@import url("../../shared.css");\n' + card.get_css())
+        menu.set_css('@import "../../shared.css";\n' + menu.get_css())
+
+        graph = b.import_graph()
+        self.assertEqual([x.name for x in graph.order()], ["shared.css", "card.css", "menu.css", "index.css"])
+        self.assertEqual({k.name: len(v) for k, v in graph.duplicates().items()}, {"shared.css": 2})
+        self.assertEqual(graph.cycles(), [])
+        self.assertEqual({x.name for x in graph.affected(shared)}, {"shared.css", "card.css", "menu.css", "index.css"})
+        self.assertEqual(b.build().read_text(), ".shared{color:red}")
+
+        shared.write_text('@import url("blocks/menu/menu.css");\n')
+        affected = graph.update(shared)
+        self.assertEqual({x.name for x in affected}, {"shared.css", "card.css", "menu.css", "index.css"})
+        self.assertEqual([[x.name for x in c] for c in graph.cycles()], [["shared.css", "menu.css", "shared.css"]])
+
+        # Files nothing imports anymore are dropped, a cycle included
+        card.set_css(card.get_default_content())
+        graph.update(card.cssFile)
+        menu.set_css('@import "../../lost.css";\n')
+        graph.update(menu.cssFile)
+        self.assertEqual({x.name for x in graph.missing}, {"lost.css"})
+        menu.set_css(menu.get_default_content())
+        graph.update(menu.cssFile)
+        self.assertEqual({x.name for x in graph.imports}, {"index.css", "card.css", "menu.css"})
+        self.assertEqual({x.name for x in graph.importers}, {"index.css", "card.css", "menu.css"})
+        self.assertEqual(graph.missing, set())
+
+        # A file added by update() is kept though the root doesn't import it
+        graph.update(shared)
+        self.assertIn(shared.resolve(), graph.imports)
+
+    def test_import_conditions(self):
+        """
+        Inlined file keeps the conditions of its import
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[0]
+        src = b.rootDir.joinpath("src")
+        src.joinpath("print.css").write_text('@import "grid.css" supports(display: grid);\n.print { color: black }\n')
+        src.joinpath("grid.css").write_text(".grid { display: grid }\n")
+        card.set_css('@import url("../../print.css") print;\n.card { color: red }\n')
+
+        self.assertEqual(b.build().read_text(),
+                         "@media print{@supports (display: grid){.grid{display:grid}}}"
+                         "@media print{.print{color:black}}.card{color:red}")
+        self.assertIn("@media print {\n.print { color: black }\n}\n", b.build(minify=False).read_text())
+
+    def test_refresh_from_git(self):
+        """
+        Update imports of the blocks changed in the working tree only
+        """
+        b = self.bem
+        b.create("block", "card")
+        b.create("block", "menu")
+        # No repository yet
+        self.assertEqual(b.refresh_from_git(), 0)
+
+        git = ["git", "-c", "user.name=test", "-c", "user.email=test@test", "-C", str(b.rootDir)]
+        subprocess.run(git + ["init", "-q"], check=True)
+        subprocess.run(git + ["add", "."], check=True)
+        subprocess.run(git + ["commit", "-qm", "init"], check=True)
+
+        # Changes made without the controller
+        shutil.rmtree(b.blocksDir / "menu")
+        b.blocksDir.joinpath("card", "__title").mkdir()
+        b.blocksDir.joinpath("card", "__title", "card__title.css").write_text(".card__title {}\n")
+        b.cssFile.write_text(b.cssFile.read_text() + '/* ghost block */\n@import url("blocks/ghost/ghost.css");\n')
+
+        self.assertEqual(b.refresh_from_git(), 2)
+        text = b.cssFile.read_text()
+        self.assertIn("blocks/card/__title/card__title.css", text)
+        self.assertNotIn("blocks/menu/menu.css", text)
+        self.assertIn("blocks/ghost/ghost.css", text)     # Untouched by git, so it is kept
+        self.assertEqual([x.name for x in b.blocks], ["card"])
+        self.assertEqual(b.blocks[0].elements[0].name, "__title")
+
+        # Controller made after the checkout doesn't know the old blocks
+        subprocess.run(git + ["add", "."], check=True)
+        subprocess.run(git + ["commit", "-qm", "title"], check=True)
+        b.create("block", "menu")
+        subprocess.run(git + ["add", "."], check=True)
+        subprocess.run(git + ["commit", "-qm", "menu"], check=True)
+        subprocess.run(git + ["rm", "-rq", str(b.blocksDir / "menu")], check=True)
+        subprocess.run(git + ["commit", "-qm", "no menu"], check=True)
+        fresh = BEM(b.rootDir, b.blocksDir, b.cssFile, autoparse=False)
+        self.assertEqual(fresh.refresh_from_git("HEAD~1"), 1)
+        self.assertNotIn("menu", b.cssFile.read_text())
+        self.assertIn("/* card block */\n@import url(\"blocks/card/card.css\");\n", b.cssFile.read_text())
+
+    def test_clone(self):
+        """
+        Copy a block subtree with renamed files, classes and imports
+        """
+        b = self.bem
+        for line in ("create b card", "create e card title", "create m card __title size s m",
+                     "create m card hidden"):
+            b.command(line)
+        b.blocksDir.joinpath("card", "card.css").write_text(
+            ".card:hover .card__title, .cardboard, .my-card {}\n.card_hidden.card {}\n")
+        b.blocksDir.joinpath("card", "icon.svg").write_text("<svg/>")
+        b.blocksDir.joinpath("card", "cardboard.css").write_text(".card .cardboard {}\n")
+
+        tile = b.clone("card", "tile")
+        self.assertEqual(tile.get_css_names(), ["tile", "tile_hidden", "tile__title", "tile__title_size_m", "tile__title_size_s"])
+        self.assertEqual(b.blocksDir.joinpath("tile", "tile.css").read_text(),
+                         ".tile:hover .tile__title, .cardboard, .my-card {}\n.tile_hidden.tile {}\n")
+        self.assertEqual(b.blocksDir.joinpath("tile", "icon.svg").read_text(), "<svg/>")
+        # Other css with the block name at the start is not an object file
+        self.assertEqual(b.blocksDir.joinpath("tile", "cardboard.css").read_text(), ".card .cardboard {}\n")
+        self.assertFalse(b.blocksDir.joinpath("tile", "tileboard.css").exists())
+        self.assertTrue(b.blocksDir.joinpath("tile", "__title", "_size", "tile__title_size_m.css").exists())
+        self.assertEqual(b.lint(), [])
+        self.assertEqual([x.name for x in b.blocks], ["card", "tile"])
+        self.assertEqual(b.fix_imports(), 0)
+        self.assertIn("tile__title_size_s", b._css_names())
+
+        with self.assertRaises(FileExistsError):
+            b.clone("card", "tile")
+        with self.assertRaises(FileNotFoundError):
+            b.clone("menu", "nav")
+
+    def test_hooks(self):
+        """
+        Events are sent once per transaction, a rename is a single event
+        """
+        b = self.bem
+        calls = []
+        for name in BEM.EVENTS:
+            b.on(name, calls.append)
+
+        with b.transaction():
+            b.create("block", "card")
+            card = b.blocks[0]
+            b.create("element", "title", card)
+            b.create("modifier", "size", card.elements[0], ["s", "m"])
+            self.assertEqual(calls, [])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([(x["event"], x["cssName"], x["value"]) for x in calls[0]], [
+            ("created", "card", None),
+            ("created", "card__title", None),
+            ("created", "card__title_size_s", "s"),
+            ("created", "card__title_size_m", "m")
+        ])
+        self.assertEqual(calls[0][1]["imports"], ['/* __title element */\n'
+                                                  '@import url("blocks/card/__title/card__title.css");\n'])
+
+        calls.clear()
+        b.rename("head", "element", "title", card)
+        self.assertEqual(len(calls), 1)
+        [event] = calls[0]
+        self.assertEqual((event["event"], event["old_cssName"], event["cssName"]), ("renamed", "card__title", "card__head"))
+        self.assertEqual(event["old_path"], b.blocksDir / "card" / "__title" / "card__title.css")
+        self.assertEqual(event["path"], b.blocksDir / "card" / "__head" / "card__head.css")
+        self.assertEqual(len(event["old_imports"]), 3)
+        self.assertEqual(len(event["imports"]), 3)
+
+        calls.clear()
+        size = card.elements[0].modifiers[0]
+        size.rename_value("s", "xs")
+        [[event]] = calls
+        self.assertEqual((event["old_cssName"], event["cssName"], event["value"]),
+                         ("card__head_size_s", "card__head_size_xs", "xs"))
+        self.assertNotIn("card__head_size_s.css", b.cssFile.read_text())
+        self.assertEqual(size.values, ["m", "xs"])
+
+        # Remove and create again is delivered in order, after the lock is released
+        b.create("modifier", "hidden", card)
+        calls.clear()
+        free = []
+
+        def check(events):
+            fd = os.open(b.cacheDir / "lock", os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                free.append(True)
+            except BlockingIOError:
+                free.append(False)
+            finally:
+                os.close(fd)
+
+        if fcntl is not None:
+            b.on("created", check)
+        with b.transaction():
+            b.remove("modifier", "hidden", card, force=True)
+            b.create("modifier", "hidden", card)
+        self.assertEqual([(x["event"], x["cssName"]) for x in calls[0]],
+                         [("removed", "card_hidden"), ("created", "card_hidden")])
+        self.assertEqual(free, [True] if fcntl is not None else [])
+        b.off("created", check)
+        b.remove("modifier", "hidden", card, force=True)
+
+        calls.clear()
+        b.off("removed", calls.append)
+        b.clone("card", "tile")
+        b.remove("block", "card", force=True)
+        self.assertEqual([x[0]["event"] for x in calls], ["created"])
+        self.assertEqual(len(calls[0]), 4)
+        with self.assertRaises(ValueError):
+            b.on("changed", calls.append)
+
+    def test_backups(self):
+        """
+        Removed and rewritten css is kept in the store once per content
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[0]
+        card.set_css(".card { color: red }\n")
+        b.create("element", "title", card)
+        index = b.cssFile.read_text()
+        self.assertEqual(b.make_import_backup().read_text(), index)
+
+        b.remove("block", "card", force=True)
+        self.assertFalse(b.blocksDir.joinpath("card").exists())
+        backup = b.backups()[0]
+        self.assertEqual(sorted(backup["files"]), ["src/blocks/card/__title/card__title.css",
+                                                   "src/blocks/card/card.css", "src/index.css"])
+        # Same index content is stored once
+        self.assertEqual(len({x["files"]["src/index.css"] for x in b.backups()[:2]}), 1)
+
+        restored = b.restore()
+        self.assertEqual(len(restored), 3)
+        self.assertEqual(b.blocksDir.joinpath("card", "card.css").read_text(), ".card { color: red }\n")
+        self.assertEqual(b.cssFile.read_text(), index)
+        self.assertEqual([x.name for x in b.blocks], ["card"])
+        self.assertEqual(b.lint(), [])
+
+        b.restore(backup["id"], [b.cssFile])
+        with self.assertRaises(FileNotFoundError):
+            b.restore("1")
+
+        b.backup_keep = 2
+        for i in range(4):
+            b.blocks[0].set_css(f".card {{ order: {i} }}\n")
+        self.assertEqual(len(b.backups()), 2)
+        kept = {d for x in b.backups() for d in x["files"].values()}
+        stored = {x.parent.name + x.name for x in b.storeDir.joinpath("objects").glob("*/*")}
+        self.assertEqual(kept, stored)
+
+    def test_prune_reads(self):
+        """
+        Pruning reads only the dropped backup, not every record and stored content
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[0]
+        b.backup_keep = 20
+        for i in range(25):
+            card.set_css(f".card {{ order: {i} }}\n")
+        with count_fs(b.storeDir) as counts:
+            card.set_css(".card { order: 25 }\n")
+        # Content and record written, index, new and dropped records read, index written
+        self.assertLessEqual(counts.get("open", 0), 7)
+        self.assertLessEqual(counts.get("os.scandir", 0) + counts.get("os.listdir", 0), 1)
+
+        self.assertEqual(len(b.backups()), 20)
+        kept = {d for x in b.backups() for d in x["files"].values()}
+        stored = {x.parent.name + x.name for x in b.storeDir.joinpath("objects").glob("*/*")}
+        self.assertEqual(kept, stored)
+
+        # Lost index is made again from the records
+        records = b._backup_files()
+        refs = b._load_refs(records)
+        self.assertEqual(set(refs), kept)
+        b.storeDir.joinpath("refs.json").unlink()
+        self.assertEqual(b._load_refs(records), refs)
+
+    def test_transaction_error(self):
+        """
+        Work done before an error is kept and written. Restore brings the import file back
+        """
+        b = self.bem
+        b.create("block", "menu")
+        index = b.cssFile.read_text()
+        with self.assertRaises(KeyError):
+            with b.transaction():
+                b.create("block", "card")
+                b.create("element", "title", b.blocks[-1])
+                raise KeyError("stop")
+
+        self.assertEqual(b._transaction_depth, 0)
+        self.assertIsNone(b._import_edits)
+        self.assertIn('@import url("blocks/card/__title/card__title.css");', b.cssFile.read_text())
+        self.assertEqual(b.lint(), [])
+
+        b.restore()
+        self.assertEqual(b.cssFile.read_text(), index)
+        self.assertTrue(b.blocksDir.joinpath("card", "card.css").exists())
+
+    def test_iterators_and_show(self):
+        """
+        Iterate objects depth-first, filter and paginate show
+        """
+        b = self.bem
+        for line in ("create b card", "create e card title", "create m card __title size s m",
+                     "create m card hidden", "create b menu", "create e menu item"):
+            b.command(line)
+        self.assertEqual([x.cssName for x in b.iter_nodes()],
+                         ["card", "card_hidden", "card__title", "card__title_size", "menu", "menu__item"])
+        self.assertEqual([x.cssName for x in b.iter_modifiers("element")], ["card__title_size"])
+        self.assertEqual(b.get_modifiers(), (tuple(b.iter_modifiers("block")), tuple(b.iter_modifiers("element"))))
+
+        out = io.StringIO()
+        self.assertEqual(b.show("element", out=out), 2)
+        self.assertEqual(out.getvalue(), f"{'Elements:':18} \tcard<-__title || menu<-__item || \n")
+
+        out = io.StringIO()
+        self.assertEqual(b.show("all", "card*", offset=1, limit=2, out=out), 4)
+        self.assertEqual(out.getvalue().splitlines(), [f"{'Elements:':18} \tcard<-__title || ",
+                                                       f"{'Block modifiers:':18} \tcard<-_hidden || "])
+
+        b.SHOW_PAGE = 4
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            b.command("show a * 2")
+        self.assertEqual(out.getvalue().splitlines(), [f"{'Block modifiers:':18} \tcard<-_hidden || ",
+                                                       f"{'Element modifiers:':18} \tcard<-__title<-_size || ",
+                                                       "Page 2 of 2. Next one: show all * 1"])
+
+    def test_value_operations(self):
+        """
+        Add, rename and remove many values with one import file change each
+        """
+        b = self.bem
+        b.create("block", "card")
+        b.create("modifier", "size", b.blocks[0], ["s", "m"])
+        size = b.blocks[0].modifiers[0]
+        folder = b.blocksDir / "card" / "_size"
+
+        size.add_values({"l": ".card_size_l { width: 3em }\n", "xl": ""})
+        self.assertEqual(size.values, ["s", "m", "l", "xl"])
+        self.assertEqual(folder.joinpath("card_size_l.css").read_text(), ".card_size_l { width: 3em }\n")
+        self.assertEqual(folder.joinpath("card_size_xl.css").read_text(), "")
+        self.assertEqual(b.lint(), [])
+        with self.assertRaises(FileExistsError):
+            size.add_values(["m"])
+
+        calls = []
+        replace = b.replace_imports
+        b.replace_imports = lambda mapping: calls.append(mapping) or replace(mapping)
+        # Swap and rename at once
+        size.rename_values({"s": "m", "m": "s", "l": "large"})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(size.values, ["m", "s", "large", "xl"])
+        self.assertEqual(folder.joinpath("card_size_large.css").read_text(), ".card_size_large { width: 3em }\n")
+        self.assertFalse(folder.joinpath("card_size_l.css").exists())
+        self.assertIn(".card_size_m", folder.joinpath("card_size_m.css").read_text())
+        # Lines are replaced in place
+        self.assertEqual(b.IMPORT_RE.findall(b.cssFile.read_text())[1:], [
+            "blocks/card/_size/card_size_m.css",
+            "blocks/card/_size/card_size_s.css",
+            "blocks/card/_size/card_size_large.css",
+            "blocks/card/_size/card_size_xl.css"
+        ])
+        self.assertEqual(b.lint(), [])
+        with self.assertRaises(FileExistsError):
+            size.rename_value("m", "s")
+
+        # A missing value stops the removal before any file is deleted
+        index = b.cssFile.read_text()
+        with self.assertRaises(FileNotFoundError):
+            size.remove_values(["large", "nope"], force=True)
+        self.assertTrue(folder.joinpath("card_size_large.css").exists())
+        self.assertEqual(b.cssFile.read_text(), index)
+        self.assertEqual(size.values, ["m", "s", "large", "xl"])
+
+        size.remove_values(["large", "xl"], force=True)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(size.values, ["m", "s"])
+        self.assertEqual(sorted(x.name for x in folder.iterdir()), ["card_size_m.css", "card_size_s.css"])
+        self.assertEqual(b.lint(), [])
+        self.assertEqual(b.fix_imports(), 0)
+
+        b.remove("modifier", "size", b.blocks[0], force=True)
+        self.assertFalse(folder.exists())
+        self.assertEqual(b.IMPORT_RE.findall(b.cssFile.read_text()), ["blocks/card/card.css"])
+
+    def test_rename_empty_css(self):
+        """
+        Renamed object with an empty css file keeps it empty instead of getting the template
+        """
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[0]
+        b.create("element", "title", card)
+        b.create("modifier", "hidden", card)
+        card.set_css("")
+        card.elements[0].set_css("")
+        card.modifiers[0].set_css("")
+
+        b.rename("head", "element", "title", card)
+        b.rename("closed", "modifier", "hidden", card)
+        b.rename("tile", "block", "card")
+        folder = b.blocksDir / "tile"
+        for x in ("tile.css", "__head/tile__head.css", "_closed/tile_closed.css"):
+            self.assertEqual(folder.joinpath(x).read_text(), "", x)
+        b.create("element", "body", b.blocks[0])
+        self.assertIn(".tile__body", folder.joinpath("__body", "tile__body.css").read_text())
+
+    def test_manifest(self):
+        """
+        Unchanged modifier folders are not listed again by parse()
+        """
+        b = self.bem
+        b.create("block", "card")
+        b.create("modifier", "size", b.blocks[0], ["x_large"])
+        b.create("modifier", "hidden", b.blocks[0])
+        folder = b.blocksDir / "card" / "_size"
+        b.parse()
+        [hidden, size] = sorted(b.blocks[0].modifiers, key=lambda x: x.name)
+        self.assertEqual((size.values, hidden.values), (["x_large"], []))
+
+        # Folders changed just now are always listed, so move their mtime to the past
+        past = time.time_ns() - 10 * b.RACY_NS
+        for x in (folder, folder.parent / "_hidden"):
+            os.utime(x, ns=(past, past))
+        b.parse()
+        manifest = b._load_cache("manifest")["modifiers"]
+        self.assertEqual(manifest["card_size"]["mtime"], past)
+        self.assertEqual(manifest["card_size"]["values"], ["x_large"])
+        self.assertEqual(manifest["card_hidden"]["values"], [])
+
+        # The folder is not listed while its mtime is the same
+        folder.joinpath("card_size_s.css").write_text("")
+        os.utime(folder, ns=(past, past))
+        b.parse()
+        size = next(x for x in b.blocks[0].modifiers if x.name == "_size")
+        self.assertEqual(size.values, ["x_large"])
+        # Another controller gets file hashes from the manifest
+        other = BEM(b.rootDir, b.blocksDir, b.cssFile)
+        self.assertIn(folder / "card_size_x_large.css", other._hashes)
+
+        os.utime(folder)
+        b.parse()
+        size = next(x for x in b.blocks[0].modifiers if x.name == "_size")
+        self.assertEqual(size.values, ["s", "x_large"])
+
+        # Listing a changed folder doesn't read its files. Hashes are taken when they are known
+        fresh = BEM(b.rootDir, b.blocksDir, b.cssFile, autoparse=False)
+        os.utime(folder)
+        with count_fs(folder) as counts:
+            fresh.parse()
+        self.assertEqual(counts.get("open", 0), 0)
+        files = fresh._load_cache("manifest")["modifiers"]["card_size"]["files"]
+        self.assertEqual(list(files), ["card_size_x_large.css"])
+
+    def test_concurrent_controllers(self):
+        """
+        Import lines of controllers working at the same time are not lost
+        """
+        b = self.bem
+        jobs = [[f"p{i}-b{j}" for j in range(10)] for i in range(4)]
+        processes = [multiprocessing.Process(target=create_blocks, args=(self.tmp.name, x)) for x in jobs]
+        for x in processes:
+            x.start()
+        for x in processes:
+            x.join()
+        self.assertTrue(all(x.exitcode == 0 for x in processes))
+
+        text = b.cssFile.read_text()
+        for name in sum(jobs, []):
+            self.assertEqual(text.count(f"blocks/{name}/{name}.css"), 1)
+
+        # Nested calls reuse an exclusive lock, a shared one is not upgraded
+        with b.transaction(), b.lock(exclusive=False):
+            b.append_import(text.splitlines(True)[1])
+        self.assertTrue(b.has_import(text.splitlines(True)[1]))
+        with b.lock(exclusive=False):
+            with self.assertRaises(RuntimeError):
+                with b.transaction():
+                    pass
+        self.assertIsNone(b._lock_fd)
+
+    @unittest.skipIf(fcntl is None, "no fcntl")
+    def test_console_waits_unlocked(self):
+        """
+        Console questions are asked while the project isn't locked
+        """
+        b = self.bem
+        b.create("block", "card")
+        answers = iter(["remove block card", "yes"])
+        free = []
+
+        def answer(prompt=""):
+            fd = os.open(b.cacheDir / "lock", os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                free.append(True)
+            except BlockingIOError:
+                free.append(False)
+            finally:
+                os.close(fd)
+            return next(answers)
+
+        with mock.patch("builtins.input", answer), contextlib.redirect_stdout(io.StringIO()):
+            b.action()
+        self.assertEqual(free, [True, True])
+        self.assertFalse(b.blocksDir.joinpath("card").exists())
+
+    def test_server(self):
+        """
+        Requests to the server change and read its warm model
+        """
+        with BEMServer(self.bem) as server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                path = server.path
+                self.assertEqual(BEMServer.call(path, "create", ["b", "card"])["cssName"], "card")
+                BEMServer.call(path, "create", ["e", "card", "title"])
+                BEMServer.call(path, "create", ["m", "card", "__title", "size", "s", "m"])
+                self.assertEqual(BEMServer.call(path, "rename", ["e", "card", "title", "head"])["cssName"],
+                                 "card__head")
+                self.assertEqual(BEMServer.call(path, "show", {"objs_type": "modifier"}),
+                                 {"modifier": ["card__head_size"]})
+                found = BEMServer.call(path, "query", ["card__head_size_m"])
+                self.assertEqual((found["type"], found["value"]), ("modifier", "m"))
+                self.assertIsNone(BEMServer.call(path, "query", ["menu"]))
+                self.assertEqual(BEMServer.call(path, "fix"), 0)
+
+                with self.assertRaises(RuntimeError):
+                    BEMServer.call(path, "create", ["b", "card"])
+                with self.assertRaises(RuntimeError):
+                    BEMServer.call(path, "drop", [])
+                self.assertTrue(BEMServer.call(path, "remove", ["b", "card"]))
+                self.assertEqual(BEMServer.call(path, "show"), {"block": [], "element": [], "modifier": []})
+                self.assertEqual(self.bem.cssFile.read_text(), "")
+
+                # Changes of another controller are seen by the next request
+                other = BEM(self.bem.rootDir, self.bem.blocksDir, self.bem.cssFile)
+                other.create("block", "menu")
+                self.assertEqual(bem_client.call(path, "show", ["block"]), {"block": ["menu"]})
+                other.remove("block", "menu", force=True)
+                self.assertIsNone(bem_client.call(path, "query", ["menu"]))
+            finally:
+                server.shutdown()
+                thread.join()
+        self.assertFalse(path.exists())
+
+    def test_controller_alone(self):
+        """
+        BEM.py is imported without the client module beside it
+        """
+        folder = self.bem.rootDir / "alone"
+        folder.mkdir()
+        shutil.copy(sys.modules["BEM"].__file__, folder)
+        subprocess.run([sys.executable, "-c", "import BEM"], cwd=folder, check=True)
+
+    def test_server_errors(self):
+        """
+        Wrong arguments and failures inside of an operation are answered with their own codes
+        """
+        def code(method, params):
+            request = json.dumps({"jsonrpc": "2.0", "id": 1, "method": method, "params": params})
+            return server.dispatch(request.encode("utf-8"))["error"]["code"]
+
+        with BEMServer(self.bem) as server:
+            self.assertEqual(code("clone", ["card"]), BEMServer.INVALID_PARAMS)
+            self.assertEqual(code("show", {"kind": "block"}), BEMServer.INVALID_PARAMS)
+            with mock.patch.object(self.bem, "fix_imports", side_effect=TypeError("inner")):
+                self.assertEqual(code("fix", []), BEMServer.INTERNAL_ERROR)
+            self.assertEqual(code("create", ["b"]), BEMServer.OPERATION_ERROR)
+
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with mock.patch.object(self.bem, "fix_imports", side_effect=KeyError("inner")):
+                    with self.assertRaisesRegex(RuntimeError, "Internal error: KeyError"):
+                        bem_client.call(server.path, "fix")
+                self.assertEqual(bem_client.call(server.path, "fix"), 0)
+            finally:
+                server.shutdown()
+                thread.join()
+
+
+class FlatLayoutTests(unittest.TestCase):
+    """
+    Flat layout keeps every file of a block in the block folder
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        make_project(self.tmp.name)
+        root = Path(self.tmp.name)
+        self.bem = BEM(root, root / "src" / "blocks", root / "src" / "index.css", layout="flat")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def scaffold(self):
+        b = self.bem
+        b.create("block", "card")
+        card = b.blocks[-1]
+        b.create("element", "title", card)
+        b.create("modifier", "size", card.elements[0], ["m", "s"])
+        b.create("modifier", "hidden", card)
+        return card
+
+    def test_create_and_parse(self):
+        """
+        Create files in the block folder and parse them back
+        """
+        b = self.bem
+        self.scaffold()
+        files = sorted(x.name for x in b.blocksDir.joinpath("card").iterdir())
+        self.assertEqual(files, ["card.css", "card__title.css", "card__title_size_m.css",
+                                 "card__title_size_s.css", "card_hidden.css"])
+        self.assertEqual([x.name for x in b.blocksDir.iterdir()], ["card"])
 
-    unittest.TextTestRunner().run(suite)
+        snapshot = json.loads(b.to_json())
+        b.parse()
+        self.assertEqual(json.loads(b.to_json()), snapshot)
+        self.assertEqual(b.lint(), [])
 
+    def test_rename_and_remove(self):
+        """
+        Rename and remove objects sharing one folder
+        """
+        b = self.bem
+        card = self.scaffold()
+        b.rename("caption", "element", "title", card)
+        b.rename("scale", "modifier", "size", card.elements[0])
+        b.remove("modifier", "hidden", card, force=True)
+        files = sorted(x.name for x in b.blocksDir.joinpath("card").iterdir())
+        self.assertEqual(files, ["card.css", "card__caption.css", "card__caption_scale_m.css",
+                                 "card__caption_scale_s.css"])
+        self.assertIn(".card__caption_scale_s {", b.blocksDir.joinpath("card", "card__caption_scale_s.css").read_text())
+        b.parse()
+        self.assertEqual(b.lint(), [])
+        self.assertEqual(len(b.import_order()), 4)
+
+        b.remove("block", "card", force=True)
+        self.assertEqual(list(b.blocksDir.iterdir()), [])
+        self.assertEqual(b.cssFile.read_text(), "")
+
+    def test_clone(self):
+        """
+        Clone a block that keeps every file in its folder
+        """
+        b = self.bem
+        self.scaffold()
+        b.clone("card", "tile")
+        files = sorted(x.name for x in b.blocksDir.joinpath("tile").iterdir())
+        self.assertEqual(files, ["tile.css", "tile__title.css", "tile__title_size_m.css",
+                                 "tile__title_size_s.css", "tile_hidden.css"])
+        self.assertEqual(b.lint(), [])
+        b.parse()
+        self.assertEqual(b.blocks[1].get_css_names(), ["tile", "tile_hidden", "tile__title", "tile__title_size_m", "tile__title_size_s"])
+
+    def test_migrate(self):
+        """
+        Move files between layouts keeping the import order
+        """
+        b = self.bem
+        self.scaffold()
+        order = [x.name for x in b.import_order()]
+        self.assertEqual(b.migrate_layout("nested"), 5)
+        self.assertTrue(b.blocksDir.joinpath("card", "__title", "_size", "card__title_size_s.css").exists())
+        self.assertEqual([x.name for x in b.import_order()], order)
+        self.assertEqual(b.lint(), [])
+
+        self.assertEqual(b.migrate_layout("flat"), 5)
+        self.assertEqual(sorted(x.name for x in b.blocksDir.joinpath("card").iterdir()),
+                         ["card.css", "card__title.css", "card__title_size_m.css",
+                          "card__title_size_s.css", "card_hidden.css"])
+        self.assertEqual([x.name for x in b.import_order()], order)
+
+    def test_migrate_assets(self):
+        """
+        Other files of the nested folders move along, relative references follow them
+        """
+        b = self.bem
+        card = self.scaffold()
+        b.migrate_layout("nested")
+        title = b.blocksDir / "card" / "__title"
+        title.joinpath("icon.svg").write_text("<svg/>")
+        b.blocksDir.joinpath("card", "bg.png").write_bytes(b"png")
+        title.joinpath("card__title.css").write_text(
+            '@import "../card.css";\n.card__title { background: url("icon.svg"), url(../bg.png), url(data:x) }\n')
+
+        self.assertEqual(b.migrate_layout("flat"), 5)
+        self.assertEqual(b.blocksDir.joinpath("card", "icon.svg").read_text(), "<svg/>")
+        self.assertEqual(b.blocksDir.joinpath("card", "card__title.css").read_text(),
+                         '@import "card.css";\n.card__title { background: url("icon.svg"), url(bg.png), url(data:x) }\n')
+
+        b.migrate_layout("nested")
+        self.assertEqual(title.joinpath("card__title.css").read_text(),
+                         '@import "../card.css";\n.card__title { background: url("../icon.svg"), url(../bg.png), url(data:x) }\n')
+
+        # Files with one name are not put together
+        title.joinpath("icon.svg").write_text("<svg></svg>")
+        with self.assertRaises(FileExistsError):
+            b.migrate_layout("flat")
+        self.assertEqual(b.layout, "nested")
+        self.assertTrue(title.joinpath("card__title.css").exists())
+        self.assertEqual(b.lint(), [])
+
+    def test_flat_names(self):
+        """
+        Names with "_" are ambiguous in flat file names
+        """
+        b = self.bem
+        card = self.scaffold()
+        with self.assertRaises(ValueError):
+            b.create("element", "big_title", card)
+        with self.assertRaises(ValueError):
+            b.rename("main_title", "element", "title", card)
+        with self.assertRaises(ValueError):
+            b.clone("card", "big_card")
+        self.assertEqual(sorted(x.name for x in b.blocksDir.iterdir()), ["card"])
+
+        b.migrate_layout("nested")
+        b.create("modifier", "dark_theme", card)
+        with self.assertRaises(ValueError):
+            b.migrate_layout("flat")
+        self.assertEqual(b.layout, "nested")
+
+
+class WorkspaceTests(unittest.TestCase):
+    def test_workspace(self):
+        """
+        Find projects, lint and fix them together
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            for name in ("shop", "admin"):
+                root.joinpath("apps", name).mkdir(parents=True)
+                b = make_project(root / "apps" / name)
+                b.create("block", f"{name}-header")
+            root.joinpath("apps", "admin", "src", "index.css").write_text("")
+
+            with BEMWorkspace(root) as ws:
+                self.assertEqual(sorted(x.rootDir.name for x in ws.projects), ["admin", "shop"])
+                lint = {k.name: len(v) for k, v in ws.lint().items()}
+                self.assertEqual(lint, {"admin": 1, "shop": 0})
+                fixed = {k.name: v for k, v in ws.fix_imports().items()}
+                self.assertEqual(fixed, {"admin": 1, "shop": 0})
+                self.assertEqual(sum(len(x) for x in ws.lint().values()), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()